@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Phase level benchmark of pycode_similar on a synthetic corpus.
+
+    $ python benchmarks/benchmark.py --files 20 --functions 30 --output bench.json
+
+Every file draws its functions from a shared pool of generated functions, then mutates them
+(rename identifiers, reorder statements, flip comparisons, insert dead code) by the given rates,
+so the corpus contains plagiarized functions of different degrees.
+The wall and CPU time of each phase are written as JSON, so the results of versions can be compared.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.realpath(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'pycode_similar'))))
+
+import gc
+import ast
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import pycode_similar
+
+_FLIPPED_OPS = {'<': '>', '>': '<', '<=': '>=', '>=': '<=', '==': '==', '!=': '!='}
+
+
+def _gen_statement(rand, names, depth=0):
+    """
+    :return: a statement spec, rendered by _render_statement
+    """
+    kind = rand.choice(('assign', 'assign', 'aug', 'if', 'for', 'call') if depth < 2 else ('assign', 'aug', 'call'))
+    a, b = rand.sample(names, 2)
+    if kind == 'assign':
+        return 'assign', a, b, rand.choice('+-*'), rand.randint(1, 9)
+    if kind == 'aug':
+        return 'aug', a, rand.choice('+-'), b
+    if kind == 'call':
+        return 'call', a, rand.choice(('len', 'abs', 'str', 'sorted')), b
+    body = [_gen_statement(rand, names, depth + 1) for _ in range(rand.randint(1, 3))]
+    if kind == 'if':
+        return 'if', a, rand.choice(sorted(_FLIPPED_OPS)), b, body
+    return 'for', a, b, body
+
+
+def _render_statement(spec, rename, flip, indent):
+    kind = spec[0]
+    if kind == 'assign':
+        _, a, b, op, n = spec
+        return ['{}{} = {} {} {}'.format(indent, rename(a), rename(b), op, n)]
+    if kind == 'aug':
+        _, a, op, b = spec
+        return ['{}{} {}= {}'.format(indent, rename(a), op, rename(b))]
+    if kind == 'call':
+        _, a, func, b = spec
+        return ['{}{} = {}({})'.format(indent, rename(a), func, rename(b))]
+    body = []
+    for sub_spec in spec[-1]:
+        body.extend(_render_statement(sub_spec, rename, flip, indent + '    '))
+    if kind == 'if':
+        _, a, op, b, _ = spec
+        if flip(spec):
+            head = '{}if {} {} {}:'.format(indent, rename(b), _FLIPPED_OPS[op], rename(a))
+        else:
+            head = '{}if {} {} {}:'.format(indent, rename(a), op, rename(b))
+        return [head] + body
+    _, a, b, _ = spec
+    return ['{}for {} in range({}):'.format(indent, rename(a), rename(b))] + body
+
+
+def generate_corpus(files=10, functions=20, pool_size=None, statements=12, rename_rate=0.3, reorder_rate=0.2,
+                    flip_rate=0.3, dead_code_rate=0.2, seed=1):
+    """
+    Generate a synthetic corpus, each file has `functions` functions drawn from a pool of base functions.
+    :param pool_size: the number of base functions, default is functions * 2
+    :param rename_rate: the probability of renaming each identifier of a drawn function
+    :param reorder_rate: the probability of swapping each pair of adjacent statements
+    :param flip_rate: the probability of flipping each comparison, e.g. a < b -> b > a
+    :param dead_code_rate: the probability of inserting a dead statement after each statement
+    :return: list of python code
+    """
+    rand = random.Random(seed)
+    pool_size = pool_size or functions * 2
+    pool = []
+    for i in range(pool_size):
+        names = ['v{}_{}'.format(i, j) for j in range(6)]
+        pool.append(('func_{}'.format(i), names, [_gen_statement(rand, names) for _ in range(statements)]))
+
+    corpus = []
+    for file_index in range(files):
+        lines = []
+        for func_name, names, body in rand.sample(pool, min(functions, pool_size)):
+            renames = dict((name, 'r{}_{}'.format(file_index, name)) for name in names + [func_name]
+                           if rand.random() < rename_rate)
+            body = list(body)
+            for k in range(len(body) - 1):
+                if rand.random() < reorder_rate:
+                    body[k], body[k + 1] = body[k + 1], body[k]
+            flips = dict((id(spec), rand.random() < flip_rate) for spec in body)
+
+            def rename(name, renames=renames):
+                return renames.get(name, name)
+
+            def flip(spec, flips=flips):
+                return flips.get(id(spec), False)
+
+            lines.append('def {}({}, {}):'.format(rename(func_name), rename(names[0]), rename(names[1])))
+            for k in range(2, len(names)):
+                lines.append('    {} = {}'.format(rename(names[k]), k))
+            for spec in body:
+                lines.extend(_render_statement(spec, rename, flip, '    '))
+                if rand.random() < dead_code_rate:
+                    lines.append('    if False:\n        {} = None'.format(rename(rand.choice(names))))
+            lines.append('    return {}\n'.format(rename(names[0])))
+        corpus.append('\n'.join(lines))
+    return corpus
+
+
+class _Timer(object):
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        best = self.results.get(self.name)
+        if best is None or wall < best['wall']:
+            self.results[self.name] = {'wall': wall, 'cpu': cpu}
+
+
+def run(corpus, repeat=3, diff_pairs=2000, tree_diff_pairs=50):
+    """
+    Time each phase of pycode_similar on the corpus, the best of repeat runs is reported.
+    :return: {phase: {'wall': seconds, 'cpu': seconds, 'count': items}}
+    """
+    phases = {}
+    counts = {}
+    for _ in range(repeat):
+        with _Timer(phases, 'parse'):
+            trees = [ast.parse(code) for code in corpus]
+        counts['parse'] = len(trees)
+
+        with _Timer(phases, 'normalize'):
+            func_nodes = []
+            for tree in trees:
+                collector = pycode_similar.FuncNodeCollector()
+                collector.visit(tree)
+                func_nodes.extend(collector.get_function_nodes())
+        counts['normalize'] = len(func_nodes)
+
+        with _Timer(phases, 'dump'):
+            for node in func_nodes:
+                pycode_similar.FuncInfo._dump(node).splitlines(True)
+        counts['dump'] = len(func_nodes)
+
+        with _Timer(phases, 'linearize'):
+            for node in func_nodes:
+                pycode_similar.FuncInfo._linearize(node)
+        counts['linearize'] = len(func_nodes)
+
+        func_info = [pycode_similar.FuncInfo(node, []) for node in func_nodes]
+        for fi in func_info:
+            fi.func_ast_tokens
+        pairs = [(func_info[i], func_info[j]) for i in range(len(func_info)) for j in range(i + 1, len(func_info))]
+        pairs = random.Random(1).sample(pairs, min(len(pairs), diff_pairs))
+
+        with _Timer(phases, 'unified_diff'):
+            for a, b in pairs:
+                pycode_similar.UnifiedDiff.diff(a, b)
+        counts['unified_diff'] = len(pairs)
+
+        with _Timer(phases, 'tree_diff'):
+            for a, b in pairs[:tree_diff_pairs]:
+                pycode_similar.TreeDiff.diff(a, b)
+        counts['tree_diff'] = min(len(pairs), tree_diff_pairs)
+
+        with _Timer(phases, 'detect'):
+            pycode_similar.detect(corpus)
+        counts['detect'] = len(corpus) - 1
+
+    for name, count in counts.items():
+        phases[name]['count'] = count
+    phases['memory'] = measure_memory(corpus)
+    return phases
+
+
+def measure_memory(corpus):
+    """
+    Trace the memory of the FuncInfo of the corpus, the full FuncInfo (AST node, source code, AST lines and
+    tokens) and the compact FuncInfo kept by iter_detect, the interned lines are counted by both.
+    :return: {'full': bytes, 'compact': bytes, 'count': functions}
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        full = [pycode_similar._build_func_info(code) for code in corpus]
+        for func_info in full:
+            for fi in func_info:
+                fi.func_ast_tokens
+        full_size = tracemalloc.get_traced_memory()[0] - base
+        compact = [[fi.compact() for fi in func_info] for func_info in full]
+        del full
+        gc.collect()
+        compact_size = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return {'full': full_size, 'compact': compact_size, 'count': sum(len(func_info) for func_info in compact)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each phase of pycode_similar on a synthetic corpus')
+    parser.add_argument('--files', type=int, default=20, help='the number of files (default: 20)')
+    parser.add_argument('--functions', type=int, default=30, help='the number of functions per file (default: 30)')
+    parser.add_argument('--statements', type=int, default=12,
+                        help='the number of top statements per function (default: 12)')
+    parser.add_argument('--rename-rate', type=float, default=0.3, help='(default: 0.3)')
+    parser.add_argument('--reorder-rate', type=float, default=0.2, help='(default: 0.2)')
+    parser.add_argument('--flip-rate', type=float, default=0.3, help='(default: 0.3)')
+    parser.add_argument('--dead-code-rate', type=float, default=0.2, help='(default: 0.2)')
+    parser.add_argument('--seed', type=int, default=1, help='(default: 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of repeat runs (default: 3)')
+    parser.add_argument('--diff-pairs', type=int, default=2000,
+                        help='the number of function pairs for UnifiedDiff (default: 2000)')
+    parser.add_argument('--tree-diff-pairs', type=int, default=50,
+                        help='the number of function pairs for TreeDiff (default: 50)')
+    parser.add_argument('--output', default=None, help='write the JSON result to this file instead of stdout')
+    args = parser.parse_args()
+
+    params = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    corpus = generate_corpus(files=args.files, functions=args.functions, statements=args.statements,
+                             rename_rate=args.rename_rate, reorder_rate=args.reorder_rate, flip_rate=args.flip_rate,
+                             dead_code_rate=args.dead_code_rate, seed=args.seed)
+    result = {
+        'version': pycode_similar.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'corpus': {'files': len(corpus), 'lines': sum(code.count('\n') + 1 for code in corpus)},
+        'phases': run(corpus, repeat=args.repeat, diff_pairs=args.diff_pairs, tree_diff_pairs=args.tree_diff_pairs),
+    }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,24 @@
 __author__ = 'fyrestone@outlook.com'
 __version__ = '1.4'
 
+import os
 import sys
 import ast
+import glob
+import zlib
+import json
+import time
+import random
 import difflib
+import hashlib
 import operator
+import heapq
 import argparse
+import tokenize
 import itertools
-from collections import Counter
+import contextlib
+from array import array
+from collections import Counter, OrderedDict
 
 # avoid using six to keep dependency clean
 if sys.version_info >= (3, 3):
@@ -22,6 +33,10 @@ else:
     string_types = basestring
 
 
+# The sentinel of missing node field.
+_MISSING = object()
+
+
 class BaseNodeNormalizer(ast.NodeTransformer):
     """
     Clean node attributes, delete the attributes that are not helpful for recognition repetition.
@@ -73,6 +88,49 @@ class BaseNodeNormalizer(ast.NodeTransformer):
     def _is_docstring(node):
         return getattr(node, 'is_docstring', False)
 
+    @staticmethod
+    def _encode_field(value, skip_node_types=()):
+        if isinstance(value, ast.AST):
+            return b'N' + BaseNodeNormalizer.structural_hash(value, skip_node_types=skip_node_types)
+        if isinstance(value, list):
+            if skip_node_types:
+                value = [v for v in value if not isinstance(v, skip_node_types)]
+            return b'L%d:' % len(value) + b''.join(BaseNodeNormalizer._encode_field(v, skip_node_types)
+                                                   for v in value)
+        r = repr(value).encode('utf-8', 'backslashreplace')
+        return b'V%d:' % len(r) + r
+
+    @staticmethod
+    def structural_hash(node, missing=_MISSING, skip_node_types=()):
+        """
+        The merkle hash of the normalized node, it is computed from the hashes of sub nodes, and
+        covers the same content of FuncInfo._dump, so the nodes with the same hash have the same AST lines.
+        The name of FunctionDef is not included, which is removed from the AST lines by FuncInfo.
+        It is computed on demand, the hash without skip_node_types is cached in node.struct_hash.
+        :param node: ast node
+        :param skip_node_types: the sub nodes of these types in node and its sub nodes are not included
+        :return: sha1 digest bytes
+        """
+        if not skip_node_types:
+            h = getattr(node, 'struct_hash', None)
+            if h is not None:
+                return h
+        encode_field = BaseNodeNormalizer._encode_field
+        parts = [type(node).__name__.encode('utf-8')]
+        for name in node._fields:
+            value = getattr(node, name, missing)
+            if value is missing:
+                continue
+            if len(parts) == 1:
+                parts.append(b'()')
+            if name == 'ctx' or (name == 'name' and isinstance(node, ast.FunctionDef)):
+                continue
+            parts.append(name.encode('utf-8') + b'=' + encode_field(value, skip_node_types))
+        h = hashlib.sha1(b''.join(parts)).digest()
+        if not skip_node_types:
+            node.struct_hash = h
+        return h
+
     def generic_visit(self, node):
         self._node_count = self._node_count + 1
         self._mark_docstring_sub_nodes(node)
@@ -234,6 +292,205 @@ class FuncNodeCollector(BaseNodeNormalizer):
         return self._func_nodes
 
 
+class FuncAndModuleNodeCollector(FuncNodeCollector):
+    """
+    Normalize and collect all function nodes, and collect the module level nodes in the same traversal.
+    The function and class nodes are kept in the module node, but they are not counted and hashed
+    as module level nodes, and the FuncInfo of module skips them by MODULE_SKIP_NODE_TYPES,
+    so the module node is the same as the module node of ModuleNodeCollector.
+    """
+
+    MODULE_SKIP_NODE_TYPES = (ast.FunctionDef, ast.ClassDef)
+
+    def __init__(self, *args, **kwargs):
+        super(FuncAndModuleNodeCollector, self).__init__(*args, **kwargs)
+        self._module_node = None
+        self._def_depth = 0
+        self._module_node_count = 0
+
+    def generic_visit(self, node):
+        if not self._def_depth:
+            self._module_node_count = self._module_node_count + 1
+        return super(FuncAndModuleNodeCollector, self).generic_visit(node)
+
+    def visit_ClassDef(self, node):
+        self._def_depth = self._def_depth + 1
+        node = super(FuncAndModuleNodeCollector, self).visit_ClassDef(node)
+        self._def_depth = self._def_depth - 1
+        return node
+
+    def visit_FunctionDef(self, node):
+        self._def_depth = self._def_depth + 1
+        node = super(FuncAndModuleNodeCollector, self).visit_FunctionDef(node)
+        self._def_depth = self._def_depth - 1
+        return node
+
+    def visit_Module(self, node):
+        self._module_node = node
+        count = self._module_node_count
+        self.generic_visit(node)
+        node.name = '__main__'
+        node.lineno = 1
+        node.col_offset = 0
+        node.nsubnodes = self._module_node_count - count
+        return node
+
+    def get_module_node(self):
+        return self._module_node
+
+
+class LineInterner(object):
+    """
+    Map each distinct normalized AST line to a small int, the same lines of all functions share one string.
+    The tokens are only meaningful in the process and the generation of the table interned them.
+    """
+
+    # the max number of lines kept between runs
+    MAX_SIZE = 1 << 20
+
+    def __init__(self):
+        self._ids = {}
+        self._lines = []
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def trim(self, max_size=MAX_SIZE):
+        """
+        Clear the table if it has more than max_size lines, so a long-lived process does not grow without limit.
+        The FuncInfo interned before intern their lines again lazily, so only trim between runs.
+        """
+        if len(self._lines) > max_size:
+            self._ids = {}
+            self._lines = []
+            self.generation = self.generation + 1
+
+    def intern(self, lines):
+        """
+        :param lines: normalized AST lines
+        :return: (interned lines, array of int tokens)
+        """
+        ids = self._ids
+        tokens = array('i')
+        for line in lines:
+            token = ids.get(line)
+            if token is None:
+                token = ids[line] = len(self._lines)
+                self._lines.append(line)
+            tokens.append(token)
+        return [self._lines[t] for t in tokens], tokens
+
+
+# The tokens of all FuncInfo in this process are interned by this table, so they can be compared to each other.
+_line_interner = LineInterner()
+
+
+class PostorderTree(object):
+    """
+    The postorder array form of a normalized function AST for Zhang-Shasha tree edit distance.
+    labels[i] is the node type name of the i-th node in postorder, lmld[i] is the index of its leftmost leaf
+    descendant, the keyroots and the forest tables are computed once and reused by every distance of this tree.
+    """
+
+    def __init__(self, labels, lmld):
+        self.labels = labels
+        self.lmld = lmld
+        # the highest node of each leftmost leaf is a keyroot, i.e. the root and the nodes have left sibling
+        self.keyroots = array('i', sorted(dict((l, i) for i, l in enumerate(lmld)).values()))
+        self._label_counts = None
+        self._forests = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def from_node(cls, node, skip=()):
+        """
+        :param node: the normalized AST node
+        :param skip: the sub nodes of these types are not in the tree
+        """
+        labels = []
+        lmld = array('i')
+        stack = [(node, -1)]
+        while stack:
+            n, start = stack.pop()
+            if start < 0:
+                # all sub nodes are written before n, the first one is the leftmost leaf
+                stack.append((n, len(labels)))
+                children = [c for c in ast.iter_child_nodes(n) if not isinstance(c, skip)]
+                children.reverse()
+                stack.extend((c, -1) for c in children)
+            else:
+                labels.append(type(n).__name__)
+                lmld.append(start)
+        return cls(labels, lmld)
+
+    @property
+    def label_counts(self):
+        if self._label_counts is None:
+            self._label_counts = Counter(self.labels)
+        return self._label_counts
+
+    @property
+    def forests(self):
+        """
+        For each keyroot k: (k, offset, labels, full, prev), the forest of k is the nodes offset+1 .. k,
+        for the x-th node of the forest, full[x] is whether it is a whole subtree of k, and prev[x] is
+        the forest index before its subtree. All lists are 1-based as the rows of the forest distance table.
+        """
+        if self._forests is None:
+            labels = self.labels
+            lmld = self.lmld
+            forests = []
+            for k in self.keyroots:
+                offset = lmld[k] - 1
+                forest = range(offset + 1, k + 1)
+                forests.append((k, offset,
+                                [None] + [labels[x] for x in forest],
+                                [False] + [lmld[x] == lmld[k] for x in forest],
+                                [0] + [lmld[x] - 1 - offset for x in forest]))
+            self._forests = forests
+        return self._forests
+
+    def distance(self, other):
+        """
+        The tree edit distance from this tree to other, removing or relabeling a node costs 1, inserting costs 0.
+        """
+        tree_dist = [[0] * len(other.labels) for _ in self.labels]
+        other_forests = other.forests
+        for i, i_offset, i_labels, i_full, i_prev in self.forests:
+            m = i - i_offset + 1
+            for j, j_offset, j_labels, j_full, j_prev in other_forests:
+                n = j - j_offset + 1
+                ys = range(1, n)
+                rows = [[0] * n]  # inserting costs 0
+                prev_row = rows[0]
+                for x in range(1, m):
+                    td_row = tree_dist[x + i_offset]
+                    label = i_labels[x]
+                    full = i_full[x]
+                    p_row = rows[i_prev[x]]
+                    row = [x] * n  # removing costs 1
+                    left = x
+                    for y in ys:
+                        if full and j_full[y]:
+                            cost = prev_row[y - 1] + (label != j_labels[y])
+                        else:
+                            cost = p_row[j_prev[y]] + td_row[y + j_offset]
+                        up = prev_row[y] + 1
+                        if up < cost:
+                            cost = up
+                        if left < cost:
+                            cost = left
+                        if full and j_full[y]:
+                            td_row[y + j_offset] = cost
+                        row[y] = left = cost
+                    rows.append(row)
+                    prev_row = row
+        return tree_dist[-1][-1]
+
+
 class FuncInfo(object):
     """
     Part of the astor library for Python AST manipulation.
@@ -245,27 +502,172 @@ class FuncInfo(object):
     class NonExistent(object):
         pass
 
-    def __init__(self, func_node, code_lines):
+    # many FuncInfo are kept while comparing a large corpus, so no __dict__ for each of them
+    __slots__ = ('_func_node', '_skip_node_types', '_code_lines', '_func_name', '_lineno', '_col_offset',
+                 '_endlineno', '_nsubnodes', '_func_hash', '_func_code', '_func_code_lines', '_func_ast',
+                 '_func_ast_lines', '_ast_line_count', '_func_ast_tokens', '_func_ast_token_counts',
+                 '_token_generation', '_fingerprints', '_func_tree', '_node_type_counts')
+
+    def __init__(self, func_node, code_lines, skip_node_types=()):
         assert isinstance(func_node, (ast.FunctionDef, ast.Module))
         self._func_node = func_node
+        self._skip_node_types = skip_node_types
         self._code_lines = code_lines
         self._func_name = func_node.__dict__.pop('name', '')
+        self._lineno = getattr(func_node, 'lineno', 0)
+        self._col_offset = getattr(func_node, 'col_offset', 0)
+        self._endlineno = getattr(func_node, 'endlineno', -1)
+        self._nsubnodes = getattr(func_node, 'nsubnodes', 0)
+        self._func_hash = None
         self._func_code = None
         self._func_code_lines = None
         self._func_ast = None
         self._func_ast_lines = None
+        self._ast_line_count = None
+        self._func_ast_tokens = None
+        self._func_ast_token_counts = None
+        self._token_generation = None
+        self._fingerprints = None
+        self._func_tree = None
+        self._node_type_counts = None
 
     def __str__(self):
         return '<' + type(self).__name__ + ': ' + self.func_name + '>'
 
+    def __getstate__(self):
+        # the int tokens are only meaningful in the process interned them, they are interned again after unpickling
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        state['_func_ast_tokens'] = None
+        state['_func_ast_token_counts'] = None
+        state['_token_generation'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def compact(self, keep_node=False, keep_tree=False, keep_code=False, keep_node_type_counts=False):
+        """
+        Get a copy only keeps the data for diff: the hash, the interned AST lines and the int tokens,
+        it is much smaller than the AST node, and cheap to be pickled to worker processes.
+        :param keep_node: keep the normalized AST node
+        :param keep_tree: keep the postorder tree, e.g. TreeDiff diffs the postorder tree
+        :param keep_code: keep the source code lines for func_code
+        :param keep_node_type_counts: keep node_type_counts, e.g. NodeTypePrescreen filters by it
+        :return: FuncInfo without the source code and the AST node unless they are kept
+        """
+        func_info = FuncInfo.__new__(FuncInfo)
+        func_info._func_node = self._func_node if keep_node else None
+        func_info._skip_node_types = self._skip_node_types
+        func_info._code_lines = self._code_lines if keep_code else None
+        func_info._func_name = self._func_name
+        func_info._lineno = self._lineno
+        func_info._col_offset = self._col_offset
+        func_info._endlineno = self._endlineno
+        func_info._nsubnodes = self._nsubnodes
+        func_info._func_hash = self.func_hash
+        func_info._func_code = None
+        func_info._func_code_lines = None
+        func_info._func_ast = None
+        func_info._func_ast_tokens = self.func_ast_tokens  # intern the lines first, so the interned lines are kept
+        func_info._func_ast_lines = self.func_ast_lines
+        func_info._ast_line_count = None
+        func_info._func_ast_token_counts = None
+        func_info._token_generation = self._token_generation
+        func_info._fingerprints = self._fingerprints
+        func_info._func_tree = self.func_tree if keep_tree else self._func_tree
+        func_info._node_type_counts = self.node_type_counts if keep_node_type_counts else None
+        return func_info
+
+    def get_state(self):
+        """
+        Get the normalized data of this function, can be serialized to json.
+        """
+        return {
+            'name': self._func_name,
+            'lineno': self._lineno,
+            'col_offset': self._col_offset,
+            'endlineno': self._endlineno,
+            'nsubnodes': self._nsubnodes,
+            'hash': self.func_hash,
+            'ast_lines': self.func_ast_lines,
+            'tree': [' '.join(self.func_tree.labels), self.func_tree.lmld.tolist()],
+        }
+
+    @classmethod
+    def from_state(cls, state, code_lines=None):
+        """
+        Restore the FuncInfo from get_state(), the restored FuncInfo has no AST node, and no postorder tree if
+        the state has no 'tree'. A state with 'ast_line_count' instead of 'ast_lines' restores a FuncInfo for
+        reporting only, it has no AST lines to diff.
+        """
+        func_info = cls.__new__(cls)
+        func_info._func_node = None
+        func_info._skip_node_types = ()
+        func_info._code_lines = code_lines
+        func_info._func_name = state['name']
+        func_info._lineno = state['lineno']
+        func_info._col_offset = state['col_offset']
+        func_info._endlineno = state['endlineno']
+        func_info._nsubnodes = state['nsubnodes']
+        func_info._func_hash = state['hash']
+        func_info._func_code = None
+        func_info._func_code_lines = None
+        func_info._func_ast = None
+        func_info._func_ast_lines = state.get('ast_lines')
+        func_info._ast_line_count = state.get('ast_line_count')
+        func_info._func_ast_tokens = None
+        func_info._func_ast_token_counts = None
+        func_info._token_generation = None
+        func_info._fingerprints = None
+        func_info._func_tree = None
+        if 'tree' in state:
+            labels, lmld = state['tree']
+            func_info._func_tree = PostorderTree([sys.intern(label) for label in labels.split()], array('i', lmld))
+        func_info._node_type_counts = None
+        return func_info
+
     @property
     def func_name(self):
         return self._func_name
 
+    @property
+    def lineno(self):
+        return self._lineno
+
+    @property
+    def col_offset(self):
+        return self._col_offset
+
+    @property
+    def endlineno(self):
+        return self._endlineno
+
+    @property
+    def nsubnodes(self):
+        return self._nsubnodes
+
+    @property
+    def func_hash(self):
+        """
+        The hex structural hash of the normalized function, the functions with the same hash are identical.
+        """
+        if self._func_hash is None:
+            self._func_hash = BaseNodeNormalizer.structural_hash(self._func_node,
+                                                                 skip_node_types=self._skip_node_types).hex()
+        return self._func_hash
+
     @property
     def func_node(self):
         return self._func_node
 
+    @property
+    def skip_node_types(self):
+        """
+        The sub nodes of these types are not a part of this function, e.g. the functions in module.
+        """
+        return self._skip_node_types
+
     @property
     def func_code(self):
         if self._func_code is None:
@@ -275,30 +677,131 @@ class FuncInfo(object):
     @property
     def func_code_lines(self):
         if self._func_code_lines is None:
-            self._func_code_lines = self._retrieve_func_code_lines(self._func_node, self._code_lines)
+            self._func_code_lines = self._retrieve_func_code_lines(self._lineno, self._endlineno, self._code_lines)
         return self._func_code_lines
 
     @property
     def func_ast(self):
         if self._func_ast is None:
-            self._func_ast = self._dump(self._func_node)
+            self._func_ast = ''.join(self.func_ast_lines)
         return self._func_ast
 
+    def _check_node(self):
+        if self._func_node is None:
+            raise ValueError('{}<{}:{}> is restored for reporting only, it has no AST node'.format(
+                    self._func_name, self._lineno, self._col_offset))
+
     @property
     def func_ast_lines(self):
         if self._func_ast_lines is None:
-            self._func_ast_lines = self.func_ast.splitlines(True)
+            self._check_node()
+            self._func_ast_lines = self._linearize(self._func_node, skip=self._skip_node_types)
         return self._func_ast_lines
 
+    @property
+    def ast_line_count(self):
+        """
+        The number of func_ast_lines, it is also known by the FuncInfo restored for reporting only.
+        """
+        if self._func_ast_lines is None and self._ast_line_count is not None:
+            return self._ast_line_count
+        return len(self.func_ast_lines)
+
+    @property
+    def func_ast_tokens(self):
+        """
+        The interned int tokens of func_ast_lines, it is much cheaper to diff than the lines.
+        """
+        if self._func_ast_tokens is None or self._token_generation != _line_interner.generation:
+            self._func_ast_lines, self._func_ast_tokens = _line_interner.intern(self.func_ast_lines)
+            self._func_ast_token_counts = None
+            self._token_generation = _line_interner.generation
+            self._func_ast = None  # the lines are enough, func_ast can be joined again
+        return self._func_ast_tokens
+
+    @property
+    def func_ast_token_counts(self):
+        """
+        The count of each token in func_ast_tokens.
+        """
+        tokens = self.func_ast_tokens
+        if self._func_ast_token_counts is None:
+            self._func_ast_token_counts = Counter(tokens)
+        return self._func_ast_token_counts
+
+    @property
+    def func_tree(self):
+        """
+        The PostorderTree of the normalized function.
+        """
+        if self._func_tree is None:
+            self._check_node()
+            self._func_tree = PostorderTree.from_node(self._func_node, skip=self._skip_node_types)
+        return self._func_tree
+
+    @property
+    def node_type_counts(self):
+        """
+        The count of each node type in the normalized function, the same as the labels of func_tree.
+        It is counted on demand, from func_tree if it is built, otherwise from the AST node without building it.
+        """
+        if self._node_type_counts is None:
+            if self._func_tree is not None:
+                self._node_type_counts = self._func_tree.label_counts
+            else:
+                self._check_node()
+                self._node_type_counts = self._count_node_types(self._func_node, self._skip_node_types)
+        return self._node_type_counts
+
     @staticmethod
-    def _retrieve_func_code_lines(func_node, code_lines):
-        if not isinstance(func_node, (ast.FunctionDef, ast.Module)):
-            return []
+    def _count_node_types(node, skip=()):
+        counts = Counter()
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            counts[type(n).__name__] += 1
+            stack.extend(c for c in ast.iter_child_nodes(n) if not isinstance(c, skip))
+        return counts
+
+    def get_fingerprints(self, k, window):
+        """
+        The winnowing fingerprints of func_ast_lines, the minimum k-gram hash of every window of k-grams.
+        :return: frozenset of fingerprints
+        """
+        if self._fingerprints is None:
+            self._fingerprints = {}
+        fingerprints = self._fingerprints.get((k, window))
+        if fingerprints is None:
+            fingerprints = self._fingerprints[(k, window)] = frozenset(
+                    self._winnow(_kgram_hashes(self.func_ast_lines, k), window))
+        return fingerprints
+
+    @staticmethod
+    def _winnow(hashes, window):
+        """
+        Select the minimum hash (the rightmost one if tie) of each window, see
+        "Winnowing: Local Algorithms for Document Fingerprinting".
+        """
+        window = min(window, len(hashes))
+        selected = []
+        last_pos = -1
+        for start in range(len(hashes) - window + 1):
+            pos = start
+            for i in range(start + 1, start + window):
+                if hashes[i] <= hashes[pos]:
+                    pos = i
+            if pos != last_pos:
+                selected.append(hashes[pos])
+                last_pos = pos
+        return selected
+
+    @staticmethod
+    def _retrieve_func_code_lines(lineno, endlineno, code_lines):
         if not isinstance(code_lines, collections.Sequence) or isinstance(code_lines, string_types):
             return []
-        if getattr(func_node, 'endlineno', -1) < getattr(func_node, 'lineno', 0):
+        if endlineno < lineno:
             return []
-        lines = code_lines[func_node.lineno - 1: func_node.endlineno]
+        lines = code_lines[lineno - 1: endlineno]
         if lines:
             padding = lines[0][:-len(lines[0].lstrip())]
             stripped_lines = []
@@ -313,7 +816,7 @@ class FuncInfo(object):
         return lines
 
     @staticmethod
-    def _iter_node(node, name='', missing=NonExistent):
+    def _iter_node(node, name='', missing=NonExistent, skip=()):
         """Iterates over an object:
            - If the object has a _fields attribute,
              it gets attributes in the order of this
@@ -331,11 +834,12 @@ class FuncInfo(object):
                     yield value, name
         elif isinstance(node, list):
             for value in node:
-                yield value, name
+                if not isinstance(value, skip):
+                    yield value, name
 
     @staticmethod
     def _dump(node, name=None, initial_indent='', indentation='    ',
-              maxline=120, maxmerged=80, special=ast.AST):
+              maxline=120, maxmerged=80, special=ast.AST, skip=()):
         """Dumps an AST or similar structure:
            - Pretty-prints with indentation
            - Doesn't print line/column/ctx info
@@ -344,7 +848,7 @@ class FuncInfo(object):
         def _inner_dump(node, name=None, indent=''):
             level = indent + indentation
             name = name and name + '=' or ''
-            values = list(FuncInfo._iter_node(node))
+            values = list(FuncInfo._iter_node(node, skip=skip))
             if isinstance(node, list):
                 prefix, suffix = '%s[' % name, ']'
             elif values:
@@ -364,6 +868,124 @@ class FuncInfo(object):
 
         return _inner_dump(node, name, initial_indent)
 
+    @staticmethod
+    def _linearize(node, indentation='    ', maxline=120, maxmerged=80, special=ast.AST, skip=(), missing=NonExistent):
+        """Emits the same lines as _dump(node).splitlines(True), without building the huge nested strings:
+           - Computes the length of each sub dump bottom-up, only the sub dump shorter
+             than maxline is built to string, because only it can be a part of one line
+           - Keeps the structure of the longer sub dumps, and writes their lines top-down
+           Both passes use an explicit stack instead of recursion.
+        """
+        indent_size = len(indentation)
+        results = []  # (length, string or None, (prefix, suffix, sub results, merged, depth) or None)
+        stack = [(node, '', 0)]
+        while stack:
+            entry = stack.pop()
+            if len(entry) == 4:  # all sub items are done
+                prefix, suffix, count, depth = entry
+                if count:
+                    kids = results[-count:]
+                    del results[-count:]
+                else:
+                    kids = []
+                length = len(prefix) + len(suffix) + 2 * (count - 1 if count else 0)
+                for kid in kids:
+                    length += kid[0]
+                indent = indent_size * depth
+                if length + indent < maxline:
+                    results.append((length, '%s%s%s' % (prefix, ', '.join([kid[1] for kid in kids]), suffix), None))
+                    continue
+                level_size = indent + indent_size
+                length = len(prefix) + len(suffix) + 1 + level_size
+                merged = bool(kids) and len(prefix) + kids[0][0] < maxmerged
+                rest = kids[1:] if merged else kids
+                if merged:
+                    length += kids[0][0] + 1
+                if rest:
+                    length += (len(rest) - 1) * (2 + level_size)
+                    for kid in rest:
+                        length += kid[0]
+                if length < maxline:
+                    level = indentation * (depth + 1)
+                    if merged:
+                        prefix = '%s%s,' % (prefix, kids[0][1])
+                    results.append((length, '%s\n%s%s%s' % (prefix, level,
+                                                            (',\n%s' % level).join([kid[1] for kid in rest]),
+                                                            suffix), None))
+                else:
+                    results.append((length, None, (prefix, suffix, kids, merged, depth)))
+                continue
+
+            value, name, depth = entry
+            name = name and name + '=' or ''
+            fields = getattr(value, '_fields', None)
+            if fields is not None:
+                values = []
+                for field in fields:
+                    field_value = getattr(value, field, missing)
+                    if field_value is not missing:
+                        values.append((field_value, field))
+                if values:
+                    sub_entries = [(a, b, depth + 1) for a, b in values if b != 'ctx']
+                    stack.append(('%s%s(' % (name, type(value).__name__), ')', len(sub_entries), depth))
+                    sub_entries.reverse()
+                    stack.extend(sub_entries)
+                    continue
+            elif isinstance(value, list):
+                sub_entries = [(v, '', depth + 1) for v in value if not isinstance(v, skip)]
+                stack.append(('%s[' % name, ']', len(sub_entries), depth))
+                sub_entries.reverse()
+                stack.extend(sub_entries)
+                continue
+            if isinstance(value, special):
+                stack.append((name + type(value).__name__, '', 0, depth))
+                continue
+            text = '%s%s' % (name, repr(value))
+            results.append((len(text), text, None))
+
+        # top-down, a result is written as its string or its structure, a tuple of str is a line break
+        lines = []
+        line = []
+        ops = [results[0]]
+        while ops:
+            op = ops.pop()
+            if isinstance(op, tuple) and len(op) == 3:
+                string = op[1]
+                if string is None:
+                    prefix, suffix, kids, merged, depth = op[2]
+                    level = (indentation * (depth + 1),)
+                    seq = [prefix]
+                    rest = kids
+                    if merged:
+                        seq.extend((kids[0], ','))
+                        rest = kids[1:]
+                    seq.append(level)
+                    for i, kid in enumerate(rest):
+                        if i:
+                            seq.extend((',', level))
+                        seq.append(kid)
+                    seq.append(suffix)
+                    seq.reverse()
+                    ops.extend(seq)
+                    continue
+                op = string
+            if isinstance(op, tuple):
+                line.append('\n')
+                lines.append(''.join(line))
+                line = [op[0]]
+            elif '\n' in op:
+                sub_lines = op.split('\n')
+                line.append(sub_lines[0])
+                for sub_line in sub_lines[1:]:
+                    line.append('\n')
+                    lines.append(''.join(line))
+                    line = [sub_line]
+            else:
+                line.append(op)
+        if line:
+            lines.append(''.join(line))
+        return lines
+
 
 class ArgParser(argparse.ArgumentParser):
     """
@@ -387,28 +1009,40 @@ class FuncDiffInfo(object):
     plagiarism_count = 0
     total_count = 0
     ast_parsing_error = False
+    approximate = False  # the diff value is estimated by lower bound because DiffBudget is used up
 
     @property
     def plagiarism_percent(self):
-        return 0 if self.total_count == 0 else (self.plagiarism_count / float(self.total_count))
+        return 0.0 if self.total_count == 0 else (self.plagiarism_count / float(self.total_count))
 
     def __str__(self):
-        if isinstance(self.info_ref, FuncInfo) and isinstance(self.info_candidate, FuncInfo):
+        if isinstance(self.info_ref, FuncInfo) and self.info_candidate is None:
+            # no candidate function is matched, e.g. ruled out by LSH or prescreen
             return '{:<4.2}: ref {}, candidate {}'.format(self.plagiarism_percent,
                                                           self.info_ref.func_name + '<' + str(
-                                                                  self.info_ref.func_node.lineno) + ':' + str(
-                                                                  self.info_ref.func_node.col_offset) + '>',
-                                                          self.info_candidate.func_name + '<' + str(
-                                                                  self.info_candidate.func_node.lineno) + ':' + str(
-                                                                  self.info_candidate.func_node.col_offset) + '>')
-        return '{:<4.2}: ref {}, candidate {}'.format(0, None, None)
+                                                                  self.info_ref.lineno) + ':' + str(
+                                                                  self.info_ref.col_offset) + '>',
+                                                          None)
+        if isinstance(self.info_ref, FuncInfo) and isinstance(self.info_candidate, FuncInfo):
+            return '{:<4.2}: ref {}, candidate {}{}'.format(self.plagiarism_percent,
+                                                            self.info_ref.func_name + '<' + str(
+                                                                    self.info_ref.lineno) + ':' + str(
+                                                                    self.info_ref.col_offset) + '>',
+                                                            self.info_candidate.func_name + '<' + str(
+                                                                    self.info_candidate.lineno) + ':' + str(
+                                                                    self.info_candidate.col_offset) + '>',
+                                                            ' (approximate)' if self.approximate else '')
+        return '{:<4.2}: ref {}, candidate {}'.format(0.0, None, None)
 
 
 class UnifiedDiff(object):
     """
-    Line diff algorithm to formatted AST string lines, naive but efficiency, result is good enough.
+    Line diff algorithm to formatted AST string lines (interned to int tokens), naive but efficiency,
+    result is good enough.
     """
 
+    requires_ast = False
+
     @staticmethod
     def diff(a, b):
         """
@@ -416,8 +1050,8 @@ class UnifiedDiff(object):
         """
         assert a is not None
         assert b is not None
-        a = a.func_ast_lines
-        b = b.func_ast_lines
+        a = a.func_ast_tokens
+        b = b.func_ast_tokens
 
         def _gen():
             for group in difflib.SequenceMatcher(None, a, b).get_grouped_opcodes(0):
@@ -435,6 +1069,46 @@ class UnifiedDiff(object):
 
         return Counter(_gen())['-']
 
+    @staticmethod
+    def diff_both(a, b):
+        """
+        Get (diff(a, b), diff(b, a)) from one SequenceMatcher run, the lines not matched
+        in a are removed lines of a -> b, and the lines not matched in b are removed lines of b -> a.
+        """
+        assert a is not None
+        assert b is not None
+        a = a.func_ast_tokens
+        b = b.func_ast_tokens
+        matched = sum(block.size for block in difflib.SequenceMatcher(None, a, b).get_matching_blocks())
+        return len(a) - matched, len(b) - matched
+
+    @staticmethod
+    def size(a):
+        """
+        diff(a, b) >= size(a) - size(b), the lines can be matched are no more than the lines of b.
+        """
+        return len(a.func_ast_tokens)
+
+    @staticmethod
+    def work(a, b):
+        """
+        The estimated work of diff(a, b), SequenceMatcher is O(len(a) * len(b)) in the worst case.
+        """
+        return len(a.func_ast_tokens) * len(b.func_ast_tokens)
+
+    @staticmethod
+    def lower_bound(a, b):
+        """
+        A cheap lower bound of diff(a, b), the lines of a not in b can never be matched.
+        """
+        b_counts = b.func_ast_token_counts
+        matched = 0
+        for token, count in a.func_ast_token_counts.items():
+            b_count = b_counts.get(token)
+            if b_count:
+                matched += count if count < b_count else b_count
+        return len(a.func_ast_tokens) - matched
+
     @staticmethod
     def total(a, b):
         assert a is not None  # b may be None
@@ -443,37 +1117,81 @@ class UnifiedDiff(object):
 
 class TreeDiff(object):
     """
-    Tree edit distance algorithm to AST, very slow and the result is not good for small functions.
+    Tree edit distance algorithm (Zhang-Shasha) to AST, the result is not good for small functions.
     """
 
+    requires_ast = False
+    requires_tree = True
+
     @staticmethod
     def diff(a, b):
         assert a is not None
         assert b is not None
+        return a.func_tree.distance(b.func_tree)
 
-        def _str_dist(i, j):
-            return 0 if i == j else 1
-
-        def _get_label(n):
-            return type(n).__name__
+    @staticmethod
+    def size(a):
+        """
+        diff(a, b) >= size(a) - size(b), the nodes can be relabeled are no more than the nodes of b.
+        """
+        return len(a.func_tree)
 
-        def _get_children(n):
-            if not hasattr(n, 'children'):
-                n.children = list(ast.iter_child_nodes(n))
-            return n.children
+    @staticmethod
+    def work(a, b):
+        """
+        The estimated work of diff(a, b), the forest distance tables of all keyroot pairs.
+        """
+        return len(a.func_tree) * len(b.func_tree)
 
-        import zss
-        res = zss.distance(a.func_node, b.func_node, _get_children,
-                           lambda node: 0,  # insert cost
-                           lambda node: _str_dist(_get_label(node), ''),  # remove cost
-                           lambda _a, _b: _str_dist(_get_label(_a), _get_label(_b)), )  # update cost
-        return res
+    @staticmethod
+    def lower_bound(a, b):
+        """
+        A cheap lower bound of diff(a, b), the nodes of a which have no same type node in b cost at least 1.
+        """
+        b_counts = b.func_tree.label_counts
+        matched = 0
+        for label, count in a.func_tree.label_counts.items():
+            b_count = b_counts.get(label)
+            if b_count:
+                matched += count if count < b_count else b_count
+        return len(a.func_tree) - matched
 
     @staticmethod
     def total(a, b):
         #  The count of AST nodes in referenced function
         assert a is not None  # b may be None
-        return a.func_node.nsubnodes
+        return a.nsubnodes
+
+
+class WinnowDiff(object):
+    """
+    Winnowing fingerprints of the normalized AST lines like Moss, the fingerprints of each function are computed
+    once, then diff is a set difference in linear time. Fast but not so accurate as UnifiedDiff.
+    """
+
+    requires_ast = False
+    k = 4  # the lines of a k-gram
+    window = 4  # the k-grams of a window
+
+    @classmethod
+    def diff(cls, a, b):
+        assert a is not None
+        assert b is not None
+        return len(a.get_fingerprints(cls.k, cls.window) - b.get_fingerprints(cls.k, cls.window))
+
+    @classmethod
+    def total(cls, a, b):
+        #  The count of fingerprints in referenced function
+        assert a is not None  # b may be None
+        return len(a.get_fingerprints(cls.k, cls.window))
+
+
+# The diff methods can be selected in console
+DIFF_METHODS = {
+    'unified': UnifiedDiff,
+    'tree': TreeDiff,
+    'winnow': WinnowDiff,
+}
 
 
 class NoFuncException(Exception):
@@ -487,182 +1205,2488 @@ class AstParsingException(Exception):
         self.source = source
 
 
-def detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False, continue_on_error=False):
-    if len(pycode_string_list) < 2:
-        return []
+def _kgram_hashes(lines, k, line_hashes=None):
+    """
+    Stable hashes of the k-grams of lines, the lines less than k are hashed as one k-gram.
+    :param line_hashes: an optional {line: hash} cache
+    """
+    hashes = []
+    for line in lines:
+        h = line_hashes.get(line) if line_hashes is not None else None
+        if h is None:
+            h = zlib.crc32(line.encode('utf-8'))
+            if line_hashes is not None:
+                line_hashes[line] = h
+        hashes.append(h)
+    k = min(k, len(hashes))
+    kgram_hashes = []
+    for i in range(len(hashes) - k + 1):
+        h = 0
+        for line_hash in hashes[i:i + k]:
+            h = ((h * 1000003) ^ line_hash) & 0xffffffff
+        kgram_hashes.append(h)
+    return kgram_hashes
+
+
+class Baseline(object):
+    """
+    The functions of the starter code handed out to everyone, like the base files of Moss. A referenced function
+    is a baseline function if its structural hash is in the baseline, or at least coverage of its k-grams of
+    normalized AST lines are in the baseline, such functions are not compared and not counted by summarize.
+    The baseline codes are normalized once, and the same baseline is reused for all candidates.
+    """
 
-    func_info_list = []
-    for index, code_str in enumerate(pycode_string_list):
-        try:
-            root_node = ast.parse(code_str)
-        except SyntaxError as e:
-            if continue_on_error and index != 0:
-                func_info_list.append((index, None))
-                continue
-            elif continue_on_error and index == 0:
-                print('Error: Can not parse reference code to AST, can not continue.')
-                raise AstParsingException(index) from e
-            else:
-                raise AstParsingException(index) from e
-        collector = FuncNodeCollector(keep_prints=keep_prints)
-        collector.visit(root_node)
-        code_utf8_lines = code_str.splitlines(True)
-        func_info = [FuncInfo(n, code_utf8_lines) for n in collector.get_function_nodes()]
-        if module_level:
-            root_node = ast.parse(code_str)
-            collector = ModuleNodeCollector(keep_prints=keep_prints)
-            collector.visit(root_node)
-            module_node = collector.get_module_node()
-            module_node.endlineno = len(code_utf8_lines)
-            module_info = FuncInfo(module_node, code_utf8_lines)
-            func_info.append(module_info)
-        func_info_list.append((index, func_info))
-
-    ast_diff_result = []
-    index_ref, func_info_ref = func_info_list[0]
-
-    if func_info_ref is not None and len(func_info_ref) == 0:
-        raise NoFuncException(index_ref)
+    def __init__(self, pycode_string_list=(), keep_prints=False, module_level=False, k=4, coverage=0.8):
+        """
+        :param keep_prints: must be the same as the option of detect
+        :param module_level: must be the same as the option of detect
+        :param coverage: the min ratio of the k-grams in baseline, None to match by structural hash only
+        """
+        self.k = k
+        self.coverage = coverage
+        self._hashes = set()
+        self._kgrams = set()
+        for code_str in pycode_string_list:
+            for func_info in _build_func_info(code_str, keep_prints=keep_prints, module_level=module_level):
+                self.add(func_info)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, func_info):
+        self._hashes.add(func_info.func_hash)
+        if self.coverage is not None:
+            self._kgrams.update(_kgram_hashes(func_info.func_ast_lines, self.k))
+
+    def __contains__(self, func_info):
+        if func_info.func_hash in self._hashes:
+            return True
+        if self.coverage is None:
+            return False
+        kgrams = set(_kgram_hashes(func_info.func_ast_lines, self.k))
+        return bool(kgrams) and len(kgrams.intersection(self._kgrams)) >= self.coverage * len(kgrams)
 
-    for index_candidate, func_info_candidate in func_info_list[1:]:
-        func_ast_diff_list = []
+    def exclude(self, func_info_list):
+        """
+        :return: the functions not in baseline
+        """
+        return [func_info for func_info in func_info_list if func_info not in self]
 
-        if func_info_candidate is None: # AST not parsed
-            ast_error_func_diff_info = FuncDiffInfo()
-            ast_error_func_diff_info.info_ref = None
-            ast_error_func_diff_info.info_candidate = None
-            ast_error_func_diff_info.ast_parsing_error = True
-            ast_error_func_diff_info.plagiarism_count = -1
-            ast_error_func_diff_info.total_count = 1
-            ast_diff_result.append((index_candidate, [ast_error_func_diff_info]))
-            continue
 
-        for fi1 in func_info_ref:
-            min_diff_value = int((1 << 31) - 1)
-            min_diff_func_info = None
-            for fi2 in func_info_candidate:
-                dv = diff_method.diff(fi1, fi2)
-                if dv < min_diff_value:
-                    min_diff_value = dv
-                    min_diff_func_info = fi2
-                if dv == 0:  # entire function structure is plagiarized by candidate
-                    break
+class FuncLSHIndex(object):
+    """
+    MinHash signatures of the shingles (n-grams of normalized AST lines) of each function, bucketed by LSH bands
+    to match the candidate functions of each referenced function.
+    Two functions with jaccard similarity s share a bucket with probability 1 - (1 - s ^ rows) ^ bands,
+    more bands gives higher recall, more rows gives fewer false candidates.
+    """
 
-            func_diff_info = FuncDiffInfo()
-            func_diff_info.info_ref = fi1
-            func_diff_info.info_candidate = min_diff_func_info
-            func_diff_info.total_count = diff_method.total(fi1, min_diff_func_info)
-            func_diff_info.plagiarism_count = func_diff_info.total_count - min_diff_value if min_diff_func_info else 0
-            func_ast_diff_list.append(func_diff_info)
-        func_ast_diff_list.sort(key=operator.attrgetter('plagiarism_percent'), reverse=True)
-        ast_diff_result.append((index_candidate, func_ast_diff_list))
+    _MERSENNE_PRIME = (1 << 61) - 1
+    _MAX_HASH = (1 << 32) - 1
+
+    def __init__(self, bands=16, rows=4, shingle_size=3, seed=1):
+        if bands < 1 or rows < 1 or shingle_size < 1:
+            raise ValueError('bands, rows and shingle_size must be positive')
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        rand = random.Random(seed)
+        self.seed = seed
+        self._permutations = [(rand.randint(1, self._MERSENNE_PRIME - 1), rand.randint(0, self._MERSENNE_PRIME - 1))
+                              for _ in range(bands * rows)]
+        self._line_hashes = {}
+
+    def _shingles(self, func_info):
+        if len(self._line_hashes) > LineInterner.MAX_SIZE:
+            self._line_hashes = {}
+        return set(_kgram_hashes(func_info.func_ast_lines, self.shingle_size, self._line_hashes))
+
+    def signature(self, func_info):
+        """
+        :return: the MinHash signature of the function, bands * rows ints
+        """
+        shingles = self._shingles(func_info)
+        prime = self._MERSENNE_PRIME
+        max_hash = self._MAX_HASH
+        if not shingles:
+            return tuple(max_hash for _ in self._permutations)
+        return tuple(min(((a * x + b) % prime) & max_hash for x in shingles) for a, b in self._permutations)
+
+    def band_keys(self, func_info):
+        """
+        :return: [(band, the rows of signature in this band), ...]
+        """
+        sig = self.signature(func_info)
+        rows = self.rows
+        return [(band, sig[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def match(self, ref_band_keys, func_info_list):
+        """
+        Find the functions which share a bucket with each referenced function, the functions are bucketed in a
+        table of this call only, so nothing is kept between the candidates.
+        :param ref_band_keys: the band_keys of each referenced function
+        :return: [indexes of functions in func_info_list (ascending) for each referenced function]
+        """
+        buckets = {}
+        for index, func_info in enumerate(func_info_list):
+            for band_key in self.band_keys(func_info):
+                buckets.setdefault(band_key, []).append(index)
+        return [sorted(set(itertools.chain.from_iterable(buckets.get(band_key, ()) for band_key in band_keys)))
+                for band_keys in ref_band_keys]
 
-    return ast_diff_result
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
-def _profile(fn):
+class NodeTypePrescreen(object):
     """
-    A simple profile decorator
-    :param fn: target function to be profiled
-    :return: The wrapper function
+    Rule out the function pairs by the similarity of node type histograms before diffing, only the pairs whose
+    similarity >= floor are diffed. The similarity is the cosine of the count vectors, or 1 - L1 distance / the sum
+    of both counts for metric 'l1'. All referenced x candidate similarities are computed as matrix operations
+    by NumPy if it is installed, otherwise in pure python.
     """
-    import functools
-    import cProfile
 
-    @functools.wraps(fn)
-    def _wrapper(*args, **kwargs):
-        pr = cProfile.Profile()
-        pr.enable()
-        res = fn(*args, **kwargs)
-        pr.disable()
-        pr.print_stats('cumulative')
-        return res
+    METRICS = ('cosine', 'l1')
+    # the max number of elements of the temporary array of L1 distances
+    _L1_BLOCK_SIZE = 1 << 22
+
+    def __init__(self, floor=0.5, metric='cosine', use_numpy=None):
+        """
+        :param use_numpy: None to use NumPy if it is installed, False to compute in pure python
+        """
+        if metric not in self.METRICS:
+            raise ValueError('metric must be one of {}'.format(', '.join(self.METRICS)))
+        self.floor = floor
+        self.metric = metric
+        self._numpy = _import_numpy() if use_numpy is None or use_numpy else None
+        if use_numpy and self._numpy is None:
+            raise ImportError('NumPy is required by use_numpy=True')
+
+    def prepare(self, func_info_ref):
+        """
+        Encode the referenced functions, the columns are the node types of them.
+        :return: the state of the referenced functions for filter
+        """
+        columns = {}
+        for fi1 in func_info_ref:
+            for name in fi1.node_type_counts:
+                columns.setdefault(name, len(columns))
+        rows = [[0] * len(columns) for _ in func_info_ref]
+        for row, fi1 in zip(rows, func_info_ref):
+            for name, count in fi1.node_type_counts.items():
+                row[columns[name]] = count
+        if self._numpy is not None:
+            rows = self._numpy.array(rows, dtype=self._numpy.float64).reshape(len(func_info_ref), len(columns))
+        return columns, rows
+
+    def _encode(self, columns, func_info_candidate):
+        """
+        :return: (count vectors on the columns, [(sum, sum of squares) of the counts of other node types])
+        """
+        rows = [[0] * len(columns) for _ in func_info_candidate]
+        others = []
+        for row, fi2 in zip(rows, func_info_candidate):
+            other_sum = other_squares = 0
+            for name, count in fi2.node_type_counts.items():
+                column = columns.get(name)
+                if column is None:
+                    other_sum += count
+                    other_squares += count * count
+                else:
+                    row[column] = count
+            others.append((other_sum, other_squares))
+        return rows, others
+
+    def similarities(self, state, func_info_candidate):
+        """
+        :param state: the result of prepare
+        :return: similarities[i][j] of the referenced function i and candidate function j
+        """
+        columns, ref_rows = state
+        rows, others = self._encode(columns, func_info_candidate)
+        if self._numpy is not None:
+            return self._similarities_numpy(ref_rows, rows, others)
+        result = []
+        for a in ref_rows:
+            if self.metric == 'cosine':
+                norm_a = sum(x * x for x in a) ** 0.5
+                result.append([_cosine(a, b, norm_a, other_squares) for b, (_, other_squares) in zip(rows, others)])
+            else:
+                sum_a = sum(a)
+                result.append([_l1_similarity(a, b, sum_a, other_sum) for b, (other_sum, _) in zip(rows, others)])
+        return result
+
+    def _similarities_numpy(self, ref_rows, rows, others):
+        np = self._numpy
+        c = np.array(rows, dtype=np.float64).reshape(len(rows), ref_rows.shape[1])
+        other_sum, other_squares = np.array(others, dtype=np.float64).reshape(len(rows), 2).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.metric == 'cosine':
+                norms = np.outer(np.sqrt((ref_rows * ref_rows).sum(axis=1)),
+                                 np.sqrt((c * c).sum(axis=1) + other_squares))
+                return np.where(norms > 0, ref_rows.dot(c.T) / norms, 0.0)
+            sums = ref_rows.sum(axis=1)[:, None] + (c.sum(axis=1) + other_sum)[None, :]
+            distances = np.empty(sums.shape)
+            block = max(1, self._L1_BLOCK_SIZE // max(1, c.size))
+            for start in range(0, ref_rows.shape[0], block):
+                a = ref_rows[start:start + block]
+                distances[start:start + block] = np.abs(a[:, None, :] - c[None, :, :]).sum(axis=2) + other_sum
+            return np.where(sums > 0, 1 - distances / sums, 0.0)
+
+    def filter(self, state, func_info_candidate):
+        """
+        :return: [indexes of candidate functions (ascending) for each referenced function]
+        """
+        similarities = self.similarities(state, func_info_candidate)
+        if self._numpy is not None:
+            return [self._numpy.flatnonzero(row >= self.floor).tolist() for row in similarities]
+        return [[j for j, similarity in enumerate(row) if similarity >= self.floor] for row in similarities]
 
-    return _wrapper
 
+def _cosine(a, b, norm_a, other_squares):
+    norm = norm_a * (sum(y * y for y in b) + other_squares) ** 0.5
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
 
-def summarize(func_ast_diff_list):
-    sum_total_count = sum(func_diff_info.total_count for func_diff_info in func_ast_diff_list)
-    sum_plagiarism_count = sum(func_diff_info.plagiarism_count for func_diff_info in func_ast_diff_list)
-    if sum_total_count == 0:
-        sum_plagiarism_percent = 0
-    else:
-        sum_plagiarism_percent = sum_plagiarism_count / float(sum_total_count)
-    return sum_plagiarism_percent, sum_plagiarism_count, sum_total_count
 
+def _l1_similarity(a, b, sum_a, other_sum):
+    total = sum_a + sum(b) + other_sum
+    return 1 - (sum(abs(x - y) for x, y in zip(a, b)) + other_sum) / float(total) if total else 0.0
 
-# @_profile
-def main():
+
+class FingerprintCache(object):
     """
-    The console_scripts Entry Point in setup.py
+    Cache the normalized FuncInfo of each code in a directory, a warm run needs not parse the code again.
+    The entry is keyed by the hash of code, the normalizer options, the tool version and the python version,
+    the least recently used entries are evicted if the total size of cache exceeds max_size.
     """
 
-    def check_line_limit(value):
-        ivalue = int(value)
-        if ivalue < 0:
-            raise argparse.ArgumentTypeError("%s is an invalid line limit" % value)
-        return ivalue
+    FORMAT_VERSION = 3
 
-    def check_percentage_limit(value):
-        ivalue = float(value)
-        if ivalue < 0:
-            raise argparse.ArgumentTypeError("%s is an invalid percentage limit" % value)
-        return ivalue
+    def __init__(self, cache_dir, max_size=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
 
-    def get_file(value):
-        return open(value, 'rb')
+    def key(self, code_str, keep_prints=False, module_level=False):
+        code_bytes = code_str if isinstance(code_str, bytes) else code_str.encode('utf-8')
+        h = hashlib.sha1(code_bytes)
+        h.update('|{}|{}|{}|{}|{}'.format(int(keep_prints), int(module_level), __version__,
+                                          '.'.join(map(str, sys.version_info[:3])),
+                                          self.FORMAT_VERSION).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key, code_lines=None):
+        """
+        :return: FuncInfo list, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                states = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return [FuncInfo.from_state(state, code_lines) for state in states]
+
+    def put(self, key, func_info):
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump([fi.get_state() for fi in func_info], f, separators=(',', ':'))
+        old_size = 0
+        if self._size is not None:
+            try:
+                old_size = os.path.getsize(path)  # the entry is replaced
+            except OSError:
+                pass
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_size:
+            self._evict()
+
+    def _entries(self):
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the total size is under 3/4 of max_size.
+        """
+        entries = sorted(self._entries(), key=operator.itemgetter(2))
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class DetectStats(object):
+    """
+    The runtime metrics of a detect run: the wall and CPU time of each phase, the counters
+    (e.g. diff calls, the candidate functions pruned or matched by hash), the largest functions
+    and the slowest function pairs. The metrics of worker processes are merged into it,
+    so the time of the match phase is the sum of all workers.
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.phases = {}  # phase: [wall, cpu]
+        self.counters = Counter()
+        self.candidate = None  # the index of candidate code in progress, for the labels of slowest pairs
+        self._largest_functions = []  # min heap of (AST lines, function)
+        self._slowest_pairs = []  # min heap of (seconds, referenced function, candidate function, diff value)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_time(self, phase, wall, cpu):
+        times = self.phases.setdefault(phase, [0.0, 0.0])
+        times[0] += wall
+        times[1] += cpu
+
+    def incr(self, counter, n=1):
+        self.counters[counter] += n
+
+    def _push(self, heap, item):
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def add_function(self, func_info, index=None):
+        """
+        :param index: the index of code of the function
+        """
+        self._push(self._largest_functions, (len(func_info.func_ast_lines), _func_label(func_info, index)))
+
+    def timed_diff(self, diff_method, fi1, fi2):
+        """
+        Call diff_method.diff(fi1, fi2) and record it.
+        """
+        start = time.perf_counter()
+        dv = diff_method.diff(fi1, fi2)
+        self.counters['diff_calls'] += 1
+        self._push(self._slowest_pairs, (time.perf_counter() - start, _func_label(fi1),
+                                         _func_label(fi2, self.candidate), dv))
+        return dv
+
+    def merge(self, other):
+        for phase, (wall, cpu) in other.phases.items():
+            self.add_time(phase, wall, cpu)
+        self.counters.update(other.counters)
+        for item in other._largest_functions:
+            self._push(self._largest_functions, item)
+        for item in other._slowest_pairs:
+            self._push(self._slowest_pairs, item)
+
+    @property
+    def largest_functions(self):
+        """
+        [(AST lines, function), ...] from the largest
+        """
+        return sorted(self._largest_functions, reverse=True)
+
+    @property
+    def slowest_pairs(self):
+        """
+        [(seconds, referenced function, candidate function, diff value), ...] from the slowest
+        """
+        return sorted(self._slowest_pairs, reverse=True)
+
+    def as_dict(self):
+        return {
+            'phases': dict((phase, {'wall': wall, 'cpu': cpu}) for phase, (wall, cpu) in self.phases.items()),
+            'counters': dict(self.counters),
+            'largest_functions': [{'ast_lines': size, 'function': name} for size, name in self.largest_functions],
+            'slowest_pairs': [{'seconds': seconds, 'ref': ref, 'candidate': candidate, 'diff_value': dv}
+                              for seconds, ref, candidate, dv in self.slowest_pairs],
+        }
+
+    def __str__(self):
+        lines = ['phases (wall / cpu seconds):']
+        for phase, (wall, cpu) in sorted(self.phases.items()):
+            lines.append('  {:<10} {:.3f} / {:.3f}'.format(phase, wall, cpu))
+        lines.append('counters:')
+        for counter, n in sorted(self.counters.items()):
+            lines.append('  {:<16} {}'.format(counter, n))
+        lines.append('largest functions (AST lines):')
+        for size, name in self.largest_functions:
+            lines.append('  {:<6} {}'.format(size, name))
+        lines.append('slowest pairs (seconds, diff value):')
+        for seconds, ref, candidate, dv in self.slowest_pairs:
+            lines.append('  {:.4f} {:<6} {} -> {}'.format(seconds, dv, ref, candidate))
+        return '\n'.join(lines)
+
+
+def _func_label(func_info, index=None):
+    label = '{}<{}:{}>'.format(func_info.func_name, func_info.lineno, func_info.col_offset)
+    return label if index is None else '{}:{}'.format(index, label)
+
+
+class DiffMemo(object):
+    """
+    The diff values of function pairs keyed by (diff method, hash of referenced function, hash of candidate function),
+    the same normalized functions in many codes (e.g. starter code and boilerplate) are diffed only once.
+    The least recently used pairs are evicted if there are more than max_size pairs.
+    """
+
+    DEFAULT_SIZE = 1 << 16
+
+    def __init__(self, max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        value = self._values.get(key)
+        if value is not None:
+            self._values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._values[key] = value
+        self._values.move_to_end(key)
+        if len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+
+def _get_memo(memo):
+    """
+    :param memo: DiffMemo, the max number of memoized pairs or None, 0 or None for no memo
+    :return: DiffMemo or None
+    """
+    if memo is None or isinstance(memo, DiffMemo):
+        return memo
+    return DiffMemo(memo) if memo > 0 else None
+
+
+class DiffBudget(object):
+    """
+    Limit the work of diffing a candidate code, so a pathological candidate can not stall the run.
+    A function pair is scored by the lower bound of diff value (the FuncDiffInfo is marked approximate) instead of
+    diffing if its estimated work (diff_method.work) exceeds pair_work, or the candidate has used up candidate_work
+    or candidate_seconds. Only the diff methods provide work and lower_bound are limited.
+    """
+
+    def __init__(self, pair_work=None, candidate_work=None, candidate_seconds=None):
+        self.pair_work = pair_work
+        self.candidate_work = candidate_work
+        self.candidate_seconds = candidate_seconds
+
+    def start(self, fraction=1.0):
+        """
+        Start to diff a candidate code, or a fraction of the referenced functions to a candidate code.
+        :return: _BudgetTracker
+        """
+        return _BudgetTracker(self, fraction)
+
+
+class _BudgetTracker(object):
+    def __init__(self, budget, fraction):
+        self.pair_work = budget.pair_work
+        self.work_left = None if budget.candidate_work is None else budget.candidate_work * fraction
+        self.deadline = None
+        if budget.candidate_seconds is not None:
+            self.deadline = time.perf_counter() + budget.candidate_seconds * fraction
+
+    def allows(self, work):
+        if self.pair_work is not None and work > self.pair_work:
+            return False
+        if self.work_left is not None and work > self.work_left:
+            return False
+        return self.deadline is None or time.perf_counter() < self.deadline
+
+    def spend(self, work):
+        if self.work_left is not None:
+            self.work_left -= work
+
+
+def _build_func_info(code_str, keep_prints=False, module_level=False, stats=None):
+    """
+    Parse and normalize the code, collect the FuncInfo of every function (and module level nodes).
+    :param code_str: python code
+    :return: FuncInfo list
+    """
+    with stats.timer('parse') if stats is not None else _null_context():
+        root_node = ast.parse(code_str)
+    with stats.timer('normalize') if stats is not None else _null_context():
+        if module_level:
+            collector = FuncAndModuleNodeCollector(keep_prints=keep_prints)
+        else:
+            collector = FuncNodeCollector(keep_prints=keep_prints)
+        collector.visit(root_node)
+    code_utf8_lines = code_str.splitlines(True)
+    func_info = [FuncInfo(n, code_utf8_lines) for n in collector.get_function_nodes()]
+    if module_level:
+        module_node = collector.get_module_node()
+        module_node.endlineno = len(code_utf8_lines)
+        module_info = FuncInfo(module_node, code_utf8_lines, skip_node_types=collector.MODULE_SKIP_NODE_TYPES)
+        func_info.append(module_info)
+    return func_info
+
+
+def _null_context():
+    return contextlib.nullcontext() if hasattr(contextlib, 'nullcontext') else contextlib.suppress()
+
+
+def _build_func_info_cached(code_str, keep_prints=False, module_level=False, cache=None, stats=None):
+    if cache is None:
+        return _build_func_info(code_str, keep_prints=keep_prints, module_level=module_level, stats=stats)
+    key = cache.key(code_str, keep_prints=keep_prints, module_level=module_level)
+    func_info = cache.get(key, code_str.splitlines(True))
+    if func_info is None:
+        func_info = _build_func_info(code_str, keep_prints=keep_prints, module_level=module_level, stats=stats)
+        cache.put(key, func_info)
+        if stats is not None:
+            stats.incr('cache_misses')
+    elif stats is not None:
+        stats.incr('cache_hits')
+    return func_info
+
+
+def _get_cache(cache, diff_method):
+    """
+    :param cache: FingerprintCache, the cache directory or None
+    :return: FingerprintCache or None if the diff method needs the AST node which is not cached
+    """
+    if cache is None or getattr(diff_method, 'requires_ast', True):
+        return None
+    if isinstance(cache, string_types):
+        return FingerprintCache(cache)
+    return cache
+
+
+def _iter_func_info_list(pycode_string_list, keep_prints=False, module_level=False, continue_on_error=False,
+                         ref_index=0, cache=None, stats=None, indexed=False):
+    """
+    Build the FuncInfo list of each code lazily, the FuncInfo list is None if the code can not be parsed.
+    :param pycode_string_list: iterable of python code, or (index, python code) if indexed
+    :param ref_index: the index of reference code which must be parsed, None if there is no such code
+    :param cache: FingerprintCache or None
+    :param stats: DetectStats or None
+    :return: generator of (index, FuncInfo list or None)
+    """
+    _line_interner.trim()  # a run starts
+    for index, code_str in (pycode_string_list if indexed else enumerate(pycode_string_list)):
+        try:
+            func_info = _build_func_info_cached(code_str, keep_prints=keep_prints, module_level=module_level,
+                                                cache=cache, stats=stats)
+        except SyntaxError as e:
+            if stats is not None:
+                stats.incr('syntax_errors')
+            if continue_on_error and index != ref_index:
+                yield index, None
+                continue
+            elif continue_on_error and index == ref_index:
+                print('Error: Can not parse reference code to AST, can not continue.')
+                raise AstParsingException(index) from e
+            else:
+                raise AstParsingException(index) from e
+        yield index, func_info
+
+
+def _build_func_info_list(pycode_string_list, keep_prints=False, module_level=False, continue_on_error=False,
+                          ref_index=0, cache=None):
+    """
+    :return: [(index, FuncInfo list or None), ...]
+    """
+    return list(_iter_func_info_list(pycode_string_list, keep_prints=keep_prints, module_level=module_level,
+                                     continue_on_error=continue_on_error, ref_index=ref_index, cache=cache))
+
+
+def _ast_error_func_diff_list():
+    ast_error_func_diff_info = FuncDiffInfo()
+    ast_error_func_diff_info.info_ref = None
+    ast_error_func_diff_info.info_candidate = None
+    ast_error_func_diff_info.ast_parsing_error = True
+    ast_error_func_diff_info.plagiarism_count = -1
+    ast_error_func_diff_info.total_count = 1
+    return [ast_error_func_diff_info]
+
+
+def _new_func_diff_info(fi1, min_diff_func_info, min_diff_value, diff_method, approximate=False):
+    func_diff_info = FuncDiffInfo()
+    func_diff_info.info_ref = fi1
+    func_diff_info.info_candidate = min_diff_func_info
+    func_diff_info.total_count = diff_method.total(fi1, min_diff_func_info)
+    func_diff_info.plagiarism_count = func_diff_info.total_count - min_diff_value if min_diff_func_info else 0
+    func_diff_info.approximate = approximate
+    return func_diff_info
+
+
+def _func_hash_index(func_info_candidate):
+    """
+    :return: {func_hash: index of the first candidate function with this hash}
+    """
+    hash_index = {}
+    for index, fi2 in enumerate(func_info_candidate):
+        hash_index.setdefault(fi2.func_hash, index)
+    return hash_index
+
+
+def _diff(diff_method, fi1, fi2, stats=None, memo=None, key=None):
+    if stats is None:
+        dv = diff_method.diff(fi1, fi2)
+    else:
+        dv = stats.timed_diff(diff_method, fi1, fi2)
+    if memo is not None:
+        memo.put(key, dv)
+    return dv
+
+
+def _find_best_match(fi1, func_info_candidate, diff_method, indexes=None, hash_index=None, stats=None,
+                     budget=None, memo=None):
+    """
+    Find the candidate function which is most similar to the referenced function fi1.
+    If there is an identical candidate function in hash_index, it is the best match without diff.
+    If diff_method provides size and lower_bound, the candidate functions are searched by the length closeness,
+    and the candidate function can not beat the current best match by its lower bound is skipped.
+    The result is the same as diffing every candidate function: the first one with min diff value.
+    :param indexes: only search these indexes of candidate functions (ascending), None for all
+    :param hash_index: the result of _func_hash_index(func_info_candidate)
+    :param stats: DetectStats or None
+    :param budget: _BudgetTracker of this candidate or None, the pair out of budget is scored by its lower bound
+    :param memo: DiffMemo or None, the memoized pairs are not diffed again
+    :return: (min diff value, index of the candidate function or -1 if not found,
+              whether the min diff value is estimated by lower bound)
+    """
+    if hash_index is not None:
+        index = hash_index.get(fi1.func_hash)
+        if index is not None:
+            if stats is not None:
+                stats.incr('exact_matches')
+            return 0, index, False  # entire function structure is plagiarized by candidate
+
+    min_diff_value = int((1 << 31) - 1)
+    min_diff_index = -1
+    if indexes is None:
+        indexes = range(len(func_info_candidate))
+    size = getattr(diff_method, 'size', None)
+    lower_bound = getattr(diff_method, 'lower_bound', None)
+    if size is None or lower_bound is None:
+        for index in indexes:
+            fi2 = func_info_candidate[index]
+            key = dv = None
+            if memo is not None:
+                key = (diff_method, fi1.func_hash, fi2.func_hash)
+                dv = memo.get(key)
+                if dv is not None and stats is not None:
+                    stats.incr('memo_hits')
+            if dv is None:
+                dv = _diff(diff_method, fi1, fi2, stats, memo, key)
+            if dv < min_diff_value:
+                min_diff_value = dv
+                min_diff_index = index
+            if dv == 0:  # entire function structure is plagiarized by candidate
+                break
+        return min_diff_value, min_diff_index, False
+
+    work = getattr(diff_method, 'work', None) if budget is not None else None
+    approximate = False
+    size1 = size(fi1)
+    order = []
+    for index in indexes:
+        size2 = size(func_info_candidate[index])
+        order.append((max(0, size1 - size2), abs(size1 - size2), index))
+    order.sort()
+    for position, (length_bound, _, index) in enumerate(order):
+        if length_bound > min_diff_value:
+            if stats is not None:
+                stats.incr('pruned_by_length', len(order) - position)
+            break  # the following candidates are even worse
+        if (length_bound, index) >= (min_diff_value, min_diff_index):
+            if stats is not None:
+                stats.incr('pruned_by_length')
+            continue
+        fi2 = func_info_candidate[index]
+        bound = lower_bound(fi1, fi2)
+        if (bound, index) >= (min_diff_value, min_diff_index):
+            if stats is not None:
+                stats.incr('pruned_by_bound')
+            continue
+        key = dv = None
+        if memo is not None:
+            key = (diff_method, fi1.func_hash, fi2.func_hash)
+            dv = memo.get(key)
+            if dv is not None and stats is not None:
+                stats.incr('memo_hits')
+        if dv is None:
+            if work is not None:
+                pair_work = work(fi1, fi2)
+                if not budget.allows(pair_work):
+                    if stats is not None:
+                        stats.incr('approximate_pairs')
+                    # the lower bound never loses to the real diff value, so only an estimated best match
+                    # is approximate
+                    min_diff_value, min_diff_index, approximate = bound, index, True
+                    continue
+                budget.spend(pair_work)
+            dv = _diff(diff_method, fi1, fi2, stats, memo, key)
+        if (dv, index) < (min_diff_value, min_diff_index):
+            min_diff_value, min_diff_index, approximate = dv, index, False
+    return min_diff_value, min_diff_index, approximate
+
+
+def _match_func(fi1, func_info_candidate, diff_method, indexes=None, hash_index=None, stats=None, budget=None,
+                memo=None):
+    """
+    Find the candidate function which is most similar to the referenced function fi1.
+    :return: FuncDiffInfo
+    """
+    min_diff_value, min_diff_index, approximate = _find_best_match(fi1, func_info_candidate, diff_method, indexes,
+                                                                   hash_index, stats, budget, memo)
+    min_diff_func_info = func_info_candidate[min_diff_index] if min_diff_index >= 0 else None
+    return _new_func_diff_info(fi1, min_diff_func_info, min_diff_value, diff_method, approximate)
+
+
+def _sort_func_ast_diff_list(func_ast_diff_list):
+    func_ast_diff_list.sort(key=operator.attrgetter('plagiarism_percent'), reverse=True)
+    return func_ast_diff_list
+
+
+# The state of worker process, initialized once by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(diff_method, func_info_ref, budget=None, memo_size=0):
+    _worker_state['diff_method'] = diff_method
+    _worker_state['func_info_ref'] = func_info_ref
+    _worker_state['budget'] = budget
+    _worker_state['memo'] = _get_memo(memo_size)  # each worker memoizes the pairs it diffs
+
+
+def _find_best_matches_in_worker(ref_start, ref_stop, func_info_candidate, indexes_list=None, with_stats=False,
+                                 index_candidate=None):
+    """
+    :return: ([(min diff value, index of the candidate function, approximate), ...], DetectStats of this task or None)
+    """
+    diff_method = _worker_state['diff_method']
+    all_func_info_ref = _worker_state['func_info_ref']
+    func_info_ref = all_func_info_ref[ref_start:ref_stop]
+    if indexes_list is None:
+        indexes_list = [None] * len(func_info_ref)
+    stats = DetectStats() if with_stats else None
+    if stats is not None:
+        stats.candidate = index_candidate
+    # the budget of the candidate is shared by the blocks of referenced functions
+    budget = _worker_state['budget']
+    budget = budget.start(len(func_info_ref) / float(len(all_func_info_ref))) if budget is not None else None
+    with stats.timer('match') if stats is not None else _null_context():
+        hash_index = _func_hash_index(func_info_candidate)
+        best_matches = [_find_best_match(fi1, func_info_candidate, diff_method, indexes, hash_index, stats, budget,
+                                         _worker_state['memo'])
+                        for fi1, indexes in zip(func_info_ref, indexes_list)]
+    return best_matches, stats
+
+
+def _collect_best_matches(func_info_ref, func_info_candidate, futures, diff_method, stats=None):
+    if func_info_candidate is None:  # AST not parsed
+        return _ast_error_func_diff_list()
+    best_matches = []
+    for f in futures:
+        block_best_matches, block_stats = f.result()
+        best_matches.extend(block_best_matches)
+        if stats is not None:
+            stats.merge(block_stats)
+    func_ast_diff_list = []
+    for fi1, (min_diff_value, min_diff_index, approximate) in zip(func_info_ref, best_matches):
+        min_diff_func_info = func_info_candidate[min_diff_index] if min_diff_index >= 0 else None
+        func_ast_diff_list.append(_new_func_diff_info(fi1, min_diff_func_info, min_diff_value, diff_method,
+                                                      approximate))
+    return _sort_func_ast_diff_list(func_ast_diff_list)
+
+
+def _iter_detect_parallel(func_info_ref, candidates, diff_method, workers, stats=None, budget=None, memo=None):
+    """
+    Compare the referenced code to each candidate in a process pool, the candidates are split to
+    (referenced function block, candidate) tasks, the compact FuncInfo is sent to workers instead of AST.
+    At most workers candidates are in flight, the results are yielded in the order of candidates.
+    :return: the same as _iter_detect_serial
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    keep_node = getattr(diff_method, 'requires_ast', True)
+    keep_tree = getattr(diff_method, 'requires_tree', False)
+    compact_ref = [fi.compact(keep_node, keep_tree) for fi in func_info_ref]
+    # split the referenced functions to blocks only if there are not enough candidates to keep workers busy
+    candidates = iter(candidates)
+    lookahead = list(itertools.islice(candidates, workers))
+    parsed_count = sum(1 for _, func_info_candidate, _ in lookahead if func_info_candidate is not None)
+    blocks = min(max(1, workers // max(1, parsed_count)), len(func_info_ref))
+    block_size = (len(func_info_ref) + blocks - 1) // blocks
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(diff_method, compact_ref, budget,
+                                       memo.max_size if memo is not None else 0)) as executor:
+        pending = deque()
+        for index_candidate, func_info_candidate, indexes_list in itertools.chain(lookahead, candidates):
+            if func_info_candidate is None:
+                pending.append((index_candidate, None, ()))
+            else:
+                compact_candidate = [fi.compact(keep_node, keep_tree) for fi in func_info_candidate]
+                futures = [executor.submit(_find_best_matches_in_worker, start, start + block_size,
+                                           compact_candidate, indexes_list and indexes_list[start:start + block_size],
+                                           stats is not None, index_candidate)
+                           for start in range(0, len(func_info_ref), block_size)]
+                pending.append((index_candidate, func_info_candidate, futures))
+            while pending and (len(pending) > workers or all(f.done() for f in pending[0][2])):
+                index_candidate, func_info_candidate, futures = pending.popleft()
+                yield index_candidate, _collect_best_matches(func_info_ref, func_info_candidate, futures,
+                                                             diff_method, stats)
+        while pending:
+            index_candidate, func_info_candidate, futures = pending.popleft()
+            yield index_candidate, _collect_best_matches(func_info_ref, func_info_candidate, futures, diff_method,
+                                                         stats)
+
+
+def _iter_detect_serial(func_info_ref, candidates, diff_method, stats=None, budget=None, memo=None):
+    """
+    :param candidates: iterable of (index of candidate, FuncInfo list or None,
+                       [indexes of candidate functions for each referenced function] or None for all)
+    :param stats: DetectStats or None
+    :param budget: DiffBudget of each candidate or None
+    :param memo: DiffMemo or None
+    :return: generator of (index of candidate, FuncDiffInfo list)
+    """
+    for index_candidate, func_info_candidate, indexes_list in candidates:
+        if func_info_candidate is None:  # AST not parsed
+            yield index_candidate, _ast_error_func_diff_list()
+            continue
+
+        if indexes_list is None:
+            indexes_list = [None] * len(func_info_ref)
+        if stats is not None:
+            stats.candidate = index_candidate
+        tracker = budget.start() if budget is not None else None
+        with stats.timer('match') if stats is not None else _null_context():
+            hash_index = _func_hash_index(func_info_candidate)
+            func_ast_diff_list = [_match_func(fi1, func_info_candidate, diff_method, indexes, hash_index, stats,
+                                              tracker, memo)
+                                  for fi1, indexes in zip(func_info_ref, indexes_list)]
+        yield index_candidate, _sort_func_ast_diff_list(func_ast_diff_list)
+
+
+def _content_hash(code_str):
+    code_bytes = code_str if isinstance(code_str, bytes) else code_str.encode('utf-8')
+    return hashlib.sha1(code_bytes).hexdigest()
+
+
+class CheckpointJournal(object):
+    """
+    An append-only journal of the finished candidates of iter_detect, a restarted run with the same journal skips
+    the candidates have been done and only compares the others. A record is tagged with the content hash of the
+    referenced code, its functions and the options, and keyed by the index and the content hash of the candidate,
+    so the records of other inputs or options are ignored. The record cut off by a crash is dropped when loading.
+    """
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, path, sync=True):
+        """
+        :param sync: fsync the journal after each record, so a finished candidate survives a power loss
+        """
+        self.path = path
+        self.sync = sync
+        self._records = {}  # {(tag, index of candidate, content hash of candidate): result state}
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get('version') == self.FORMAT_VERSION:
+                self._records[(record['tag'], record['index'], record['candidate'])] = record['result']
+        if end < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, tag, index, candidate_hash):
+        """
+        :return: the result state, or None if the candidate has not been done
+        """
+        return self._records.get((tag, index, candidate_hash))
+
+    def append(self, tag, index, candidate_hash, state):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps({'version': self.FORMAT_VERSION, 'tag': tag, 'index': index,
+                                     'candidate': candidate_hash, 'result': state}, separators=(',', ':')) + '\n')
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._records[(tag, index, candidate_hash)] = state
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def tag(ref_hash, func_info_ref, diff_method, keep_prints=False, module_level=False, lsh=None, budget=None,
+            prescreen=None):
+        """
+        The tag of the referenced code and the options which change the result of a candidate, the functions
+        excluded by Baseline are reflected by the hashes of func_info_ref.
+        """
+        options = [__version__, CheckpointJournal.FORMAT_VERSION, diff_method.__name__, keep_prints, module_level]
+        if lsh is not None:
+            options.append((lsh.bands, lsh.rows, lsh.shingle_size, lsh.seed))
+        if budget is not None:
+            options.append((budget.pair_work, budget.candidate_work, budget.candidate_seconds))
+        if prescreen is not None:
+            options.append((prescreen.floor, prescreen.metric))
+        h = hashlib.sha1(ref_hash.encode('utf-8'))
+        h.update(repr(options).encode('utf-8'))
+        for fi in func_info_ref:
+            h.update(fi.func_hash.encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def dump_result(func_info_ref, func_ast_diff_list):
+        """
+        :return: the json state of the FuncDiffInfo list, the referenced functions are stored by their index
+        """
+        if any(func_diff_info.ast_parsing_error for func_diff_info in func_ast_diff_list):
+            return {'ast_parsing_error': True}
+        ref_indexes = dict((id(fi), index) for index, fi in enumerate(func_info_ref))
+        functions = []
+        for func_diff_info in func_ast_diff_list:
+            fi2 = func_diff_info.info_candidate
+            candidate_state = None if fi2 is None else {
+                'name': fi2.func_name,
+                'lineno': fi2.lineno,
+                'col_offset': fi2.col_offset,
+                'endlineno': fi2.endlineno,
+                'nsubnodes': fi2._nsubnodes,
+                'hash': fi2.func_hash,
+                'ast_line_count': fi2.ast_line_count,
+            }
+            functions.append([ref_indexes[id(func_diff_info.info_ref)], candidate_state,
+                              func_diff_info.plagiarism_count, func_diff_info.total_count,
+                              func_diff_info.approximate])
+        return {'functions': functions}
+
+    @staticmethod
+    def load_result(func_info_ref, state, func_info_candidate=None):
+        """
+        Restore the FuncDiffInfo list from dump_result.
+        :param func_info_candidate: the FuncInfo list normalized from the candidate code again, the matched
+                                    functions are taken from it, None for the FuncInfo restored from the journal,
+                                    which has no AST node and no AST lines, it is for reporting only
+        """
+        if state.get('ast_parsing_error'):
+            return _ast_error_func_diff_list()
+        candidates = {}
+        for fi in func_info_candidate or ():
+            candidates[(fi.lineno, fi.col_offset, fi.func_hash)] = fi
+        func_ast_diff_list = []
+        for ref_index, candidate_state, plagiarism_count, total_count, approximate in state['functions']:
+            func_diff_info = FuncDiffInfo()
+            func_diff_info.info_ref = func_info_ref[ref_index]
+            if candidate_state is not None:
+                func_diff_info.info_candidate = candidates.get(
+                        (candidate_state['lineno'], candidate_state['col_offset'], candidate_state['hash']))
+                if func_diff_info.info_candidate is None:
+                    func_diff_info.info_candidate = FuncInfo.from_state(candidate_state)
+            func_diff_info.plagiarism_count = plagiarism_count
+            func_diff_info.total_count = total_count
+            func_diff_info.approximate = approximate
+            func_ast_diff_list.append(func_diff_info)
+        return func_ast_diff_list
+
+
+def iter_detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False,
+                continue_on_error=False, workers=None, cache=None, lsh=None, keep_code=True, stats=None,
+                budget=None, prescreen=None, memo=DiffMemo.DEFAULT_SIZE, baseline=None, checkpoint=None):
+    """
+    Compare the referenced code (the first code) to each candidate code, the same as detect, but the candidate
+    codes are parsed lazily and the result of each candidate is yielded as soon as it is done, only the FuncInfo
+    of the referenced code and the candidates in progress are kept in memory.
+    The AST node is released once the FuncInfo is built unless the diff_method requires it.
+    :param pycode_string_list: iterable of python code, e.g. a generator reading files one by one
+    :param keep_code: keep the source code for FuncInfo.func_code of the result
+    :param stats: DetectStats, the runtime metrics are added to it, None for no metrics
+    :param budget: DiffBudget of each candidate, None for no limit
+    :param prescreen: NodeTypePrescreen, only diff the function pairs pass it, None for diffing all pairs
+    :param memo: DiffMemo or the max number of memoized function pairs, 0 or None for no memo
+    :param baseline: Baseline, the referenced functions in it are not compared, None for no baseline
+    :param checkpoint: CheckpointJournal or its path, the result of each candidate is appended to it once it is
+                       done, and the candidates in it are restored instead of compared, None for no checkpoint.
+                       The restored candidates are normalized again if keep_code, otherwise their FuncInfo is
+                       for reporting only and has no AST lines
+    :return: generator of (index of candidate, FuncDiffInfo list)
+    """
+    from collections import deque
+
+    keep_node = getattr(diff_method, 'requires_ast', True)
+    keep_tree = getattr(diff_method, 'requires_tree', False)
+    keep_node_type_counts = prescreen is not None
+
+    def _compact(index, func_info):
+        if func_info is None:
+            return None
+        if stats is None:
+            return [fi.compact(keep_node, keep_tree, keep_code, keep_node_type_counts) for fi in func_info]
+        with stats.timer('dump'):
+            func_info = [fi.compact(keep_node, keep_tree, keep_code, keep_node_type_counts) for fi in func_info]
+        stats.incr('functions', len(func_info))
+        for fi in func_info:
+            stats.add_function(fi, index)
+        return func_info
+
+    journal = CheckpointJournal(checkpoint) if isinstance(checkpoint, string_types) else checkpoint
+    tag = None
+    code_hashes = {}  # {index: content hash} of the codes being compared
+    restored = deque()  # (index, result state, code) of the candidates done by the last run, by index
+
+    def _pending_codes():
+        for index, code_str in enumerate(pycode_string_list):
+            if journal is not None:
+                code_hash = _content_hash(code_str)
+                if index > 0:
+                    state = journal.get(tag, index, code_hash)
+                    if state is not None:
+                        restored.append((index, state, code_str if keep_code else None))
+                        continue
+                code_hashes[index] = code_hash
+            yield index, code_str
+
+    func_info_cache = _get_cache(cache, diff_method)
+    func_info_iter = ((index, _compact(index, func_info))
+                      for index, func_info in _iter_func_info_list(_pending_codes(), keep_prints=keep_prints,
+                                                                   module_level=module_level,
+                                                                   continue_on_error=continue_on_error,
+                                                                   cache=func_info_cache,
+                                                                   stats=stats, indexed=True))
+    first = next(func_info_iter, None)
+    if first is None:
+        return
+    index_ref, func_info_ref = first
+
+    if baseline is not None:
+        func_info_count = len(func_info_ref)
+        func_info_ref = baseline.exclude(func_info_ref)
+        if stats is not None:
+            stats.incr('baseline_functions', func_info_count - len(func_info_ref))
+    if len(func_info_ref) == 0:
+        raise NoFuncException(index_ref)
+    if journal is not None:
+        tag = CheckpointJournal.tag(code_hashes.pop(index_ref), func_info_ref, diff_method, keep_prints, module_level,
+                                    lsh, budget, prescreen)
+
+    def _candidates():
+        ref_band_keys = [lsh.band_keys(fi1) for fi1 in func_info_ref] if lsh is not None else None
+        ref_prescreen_state = prescreen.prepare(func_info_ref) if prescreen is not None else None
+        for index_candidate, func_info_candidate in func_info_iter:
+            if stats is not None:
+                stats.incr('candidates')
+            indexes_list = None
+            if lsh is not None and func_info_candidate is not None:
+                with stats.timer('lsh') if stats is not None else _null_context():
+                    indexes_list = lsh.match(ref_band_keys, func_info_candidate)
+            if prescreen is not None and func_info_candidate is not None:
+                with stats.timer('prescreen') if stats is not None else _null_context():
+                    prescreen_indexes_list = prescreen.filter(ref_prescreen_state, func_info_candidate)
+                if stats is not None:
+                    stats.incr('prescreened_pairs', len(func_info_ref) * len(func_info_candidate) -
+                               sum(len(indexes) for indexes in prescreen_indexes_list))
+                if indexes_list is None:
+                    indexes_list = prescreen_indexes_list
+                else:
+                    indexes_list = [sorted(set(indexes).intersection(prescreen_indexes))
+                                    for indexes, prescreen_indexes in zip(indexes_list, prescreen_indexes_list)]
+            yield index_candidate, func_info_candidate, indexes_list
+
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers is not None and workers > 1:
+        results = _iter_detect_parallel(func_info_ref, _candidates(), diff_method, workers, stats, budget,
+                                        _get_memo(memo))
+    else:
+        results = _iter_detect_serial(func_info_ref, _candidates(), diff_method, stats, budget, _get_memo(memo))
+    if journal is None:
+        yield from results
+        return
+
+    def _restore(index_candidate, state, code_str):
+        if stats is not None:
+            stats.incr('restored_candidates')
+        func_info_candidate = None
+        if code_str is not None and not state.get('ast_parsing_error'):
+            # normalize the candidate again, the diffs are not redone, but the result has the real FuncInfo
+            func_info_candidate = [fi.compact(keep_node, keep_tree, keep_code) for fi in _build_func_info_cached(
+                    code_str, keep_prints=keep_prints, module_level=module_level, cache=func_info_cache)]
+        return index_candidate, CheckpointJournal.load_result(func_info_ref, state, func_info_candidate)
 
-    parser = ArgParser(description='A simple plagiarism detection tool for python code')
-    parser.add_argument('files', type=get_file, nargs='+',
-                        help='the input files. First file being the reference file.')
-    parser.add_argument('-l', type=check_line_limit, default=4,
-                        help='if AST line of the function >= value then output detail (default: 4)')
-    parser.add_argument('-p', type=check_percentage_limit, default=0.5,
-                        help='if plagiarism percentage of the function >= value then output detail (default: 0.5)')
-    parser.add_argument('-k', '--keep-prints', action='store_true', default=False,
-                        help='keep print nodes')
-    parser.add_argument('-m', '--module-level', action='store_true', default=False,
-                        help='process module level nodes')
-    parser.add_argument('-c', '--continue-on-error', action='store_true', default=False,
-                        help='Continue on AST parsing error for candidate files. Reference code must be syntactically correct.')
-    args = parser.parse_args()
-    pycode_list = [(f.name, f.read()) for f in args.files]
     try:
-        results = detect(
-            [c[1] for c in pycode_list],
-            keep_prints=args.keep_prints,
-            module_level=args.module_level,
-            continue_on_error=args.continue_on_error
-        )
-    except NoFuncException as ex:
-        print('error: can not find functions from {}.'.format(pycode_list[ex.source][0]))
+        for index_candidate, func_ast_diff_list in results:
+            while restored and restored[0][0] < index_candidate:
+                yield _restore(*restored.popleft())
+            journal.append(tag, index_candidate, code_hashes.pop(index_candidate),
+                           CheckpointJournal.dump_result(func_info_ref, func_ast_diff_list))
+            yield index_candidate, func_ast_diff_list
+        while restored:
+            yield _restore(*restored.popleft())
+    finally:
+        if journal is not checkpoint:
+            journal.close()
+
+
+def detect(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False, continue_on_error=False,
+           workers=None, cache=None, lsh=None, stats=None, budget=None, prescreen=None, memo=DiffMemo.DEFAULT_SIZE,
+           baseline=None, checkpoint=None):
+    """
+    Compare the referenced code (the first code) to each candidate code.
+    :param workers: the number of worker processes, 0 means the number of CPUs, None or 1 runs in current process
+    :param cache: FingerprintCache or a cache directory, it is ignored if diff_method requires AST node
+    :param lsh: FuncLSHIndex, a referenced function is only diffed with the candidate functions share an LSH bucket
+                with it (FuncLSHIndex.match), None for diffing all candidate functions
+    :param stats: DetectStats, the runtime metrics are added to it, None for no metrics
+    :param budget: DiffBudget of each candidate, the function pairs out of budget are estimated, None for no limit
+    :param prescreen: NodeTypePrescreen, the function pairs with dissimilar node type histograms are not diffed,
+                      None for diffing all function pairs
+    :param memo: DiffMemo or the max number of memoized function pairs, the same normalized function pair of
+                 different codes is diffed only once, 0 or None for no memo
+    :param baseline: Baseline of the starter code, the referenced functions in it are not compared and not counted,
+                     None for no baseline
+    :param checkpoint: CheckpointJournal or its path, the finished candidates are journaled, a restarted run with
+                       the same codes and options only compares the candidates not in it, None for no checkpoint
+    :return: [(index of candidate, FuncDiffInfo list), ...]
+    """
+    if len(pycode_string_list) < 2:
+        return []
+
+    return list(iter_detect(pycode_string_list, diff_method=diff_method, keep_prints=keep_prints,
+                            module_level=module_level, continue_on_error=continue_on_error, workers=workers,
+                            cache=cache, lsh=lsh, stats=stats, budget=budget, prescreen=prescreen, memo=memo,
+                            baseline=baseline, checkpoint=checkpoint))
+
+
+def _diff_both(diff_method, a, b):
+    if a.func_hash == b.func_hash:
+        return 0, 0
+    diff_both = getattr(diff_method, 'diff_both', None)
+    if diff_both is not None:
+        return diff_both(a, b)
+    return diff_method.diff(a, b), diff_method.diff(b, a)
+
+
+def _match_func_by_diff_values(func_info_ref, func_info_candidate, diff_values, diff_method):
+    """
+    The same as _match_func, but the diff values of each function pair have been computed.
+    :param diff_values: diff_values[i][j] is the diff value of func_info_ref[i] -> func_info_candidate[j]
+    :return: FuncDiffInfo list
+    """
+    func_ast_diff_list = []
+    for fi1, row in zip(func_info_ref, diff_values):
+        min_diff_value = int((1 << 31) - 1)
+        min_diff_func_info = None
+        for fi2, dv in zip(func_info_candidate, row):
+            if dv < min_diff_value:
+                min_diff_value = dv
+                min_diff_func_info = fi2
+            if dv == 0:
+                break
+        func_ast_diff_list.append(_new_func_diff_info(fi1, min_diff_func_info, min_diff_value, diff_method))
+    return _sort_func_ast_diff_list(func_ast_diff_list)
+
+
+def _exclude_rows(baseline, func_info_ref, diff_values):
+    """
+    :return: (the referenced functions not in baseline, their rows of diff_values)
+    """
+    if baseline is None:
+        return func_info_ref, diff_values
+    rows = [(fi1, row) for fi1, row in zip(func_info_ref, diff_values) if fi1 not in baseline]
+    return [fi1 for fi1, _ in rows], [row for _, row in rows]
+
+
+def detect_all_pairs(pycode_string_list, diff_method=UnifiedDiff, keep_prints=False, module_level=False,
+                     continue_on_error=False, cache=None, baseline=None):
+    """
+    Compare every code to each other, each code is parsed and normalized only once,
+    and the diff of both directions of a function pair is computed together.
+    Note: for UnifiedDiff, the b -> a direction is read from the same alignment of a -> b,
+    it may differ slightly from detect([b, a]) because SequenceMatcher is not symmetric.
+    :param baseline: Baseline, the referenced functions in it are not in the result, None for no baseline
+    :return: N x N matrix, matrix[i][j] is the FuncDiffInfo list of code i (referenced) -> code j (candidate),
+             matrix[i][i] and the rows of the code that can not be parsed are None.
+    """
+    func_info_list = _build_func_info_list(pycode_string_list, keep_prints=keep_prints, module_level=module_level,
+                                           continue_on_error=continue_on_error, ref_index=None,
+                                           cache=_get_cache(cache, diff_method))
+    for index, func_info in func_info_list:
+        if func_info is not None and len(func_info) == 0 and not continue_on_error:
+            raise NoFuncException(index)
+
+    size = len(func_info_list)
+    matrix = [[None] * size for _ in range(size)]
+    for index_a, func_info_a in func_info_list:
+        for index_b, func_info_b in func_info_list[index_a + 1:]:
+            if func_info_a is None or func_info_b is None:
+                if func_info_a is not None:
+                    matrix[index_a][index_b] = _ast_error_func_diff_list()
+                if func_info_b is not None:
+                    matrix[index_b][index_a] = _ast_error_func_diff_list()
+                continue
+            diff_values_ab = [[0] * len(func_info_b) for _ in func_info_a]
+            diff_values_ba = [[0] * len(func_info_a) for _ in func_info_b]
+            for i, fi1 in enumerate(func_info_a):
+                for j, fi2 in enumerate(func_info_b):
+                    diff_values_ab[i][j], diff_values_ba[j][i] = _diff_both(diff_method, fi1, fi2)
+            ref_a, diff_values_ab = _exclude_rows(baseline, func_info_a, diff_values_ab)
+            ref_b, diff_values_ba = _exclude_rows(baseline, func_info_b, diff_values_ba)
+            matrix[index_a][index_b] = _match_func_by_diff_values(ref_a, func_info_b, diff_values_ab, diff_method)
+            matrix[index_b][index_a] = _match_func_by_diff_values(ref_b, func_info_a, diff_values_ba, diff_method)
+    return matrix
+
+
+def _summarize_with_cutoff(func_info_ref, func_info_candidate, diff_method, cutoff=None, stats=None, memo=None):
+    """
+    Summarize the plagiarism of func_info_ref by func_info_candidate, the same as summarize(_match_func ...),
+    but stop once the plagiarism percent can not be greater than cutoff.
+    The upper bound of the plagiarism count is the sum of the matched counts and the bounds of the unmatched
+    functions, total - the min lower bound of diff value (total if diff_method provides no lower_bound).
+    :return: (plagiarism percent, plagiarism count, total count), or None if it is not greater than cutoff
+    """
+    totals = [diff_method.total(fi1, None) for fi1 in func_info_ref]
+    sum_total_count = sum(totals)
+    hash_index = _func_hash_index(func_info_candidate)
+    if cutoff is None:
+        bounds = list(totals)
+    else:
+        lower_bound = getattr(diff_method, 'lower_bound', None)
+        bounds = []
+        for fi1, total in zip(func_info_ref, totals):
+            if fi1.func_hash in hash_index or lower_bound is None or not func_info_candidate:
+                bounds.append(total if func_info_candidate else 0)
+            else:
+                bounds.append(total - min(lower_bound(fi1, fi2) for fi2 in func_info_candidate))
+    def _percent(count):
+        return count / float(sum_total_count) if sum_total_count else 0
+
+    upper_bound = sum(bounds)
+    for fi1, total, bound in zip(func_info_ref, totals, bounds):
+        if cutoff is not None and _percent(upper_bound) <= cutoff:
+            if stats is not None:
+                stats.incr('pruned_by_top_k')
+            return None
+        min_diff_value, min_diff_index, _ = _find_best_match(fi1, func_info_candidate, diff_method,
+                                                             hash_index=hash_index, stats=stats, memo=memo)
+        upper_bound += (total - min_diff_value if min_diff_index >= 0 else 0) - bound
+    if cutoff is not None and _percent(upper_bound) <= cutoff:
+        return None
+    return _percent(upper_bound), upper_bound, sum_total_count
+
+
+def detect_top_k(pycode_string_list, k=10, diff_method=UnifiedDiff, keep_prints=False, module_level=False,
+                 continue_on_error=False, all_pairs=False, cache=None, stats=None, memo=DiffMemo.DEFAULT_SIZE,
+                 baseline=None):
+    """
+    Find the k most similar pairs by the summarized plagiarism percent, only the summary of the top k pairs is kept
+    in a bounded heap, and the pair which can not beat the k-th best percent by its upper bound is skipped.
+    :param pycode_string_list: iterable of python code, the candidate codes are parsed lazily unless all_pairs
+    :param k: the number of pairs to keep
+    :param all_pairs: compare every code to each other, instead of the first code to the others
+    :param stats: DetectStats, the runtime metrics are added to it, None for no metrics
+    :param memo: DiffMemo or the max number of memoized function pairs, 0 or None for no memo
+    :param baseline: Baseline, the referenced functions in it are not compared and not counted, None for no baseline
+    :return: [(plagiarism percent, plagiarism count, total count, index of referenced code, index of candidate),
+              ...] sorted by plagiarism percent descending, the earlier pair wins a tie
+    """
+    if k <= 0:
+        return []
+    exclude = baseline.exclude if baseline is not None else list
+    keep_node = getattr(diff_method, 'requires_ast', True)
+    keep_tree = getattr(diff_method, 'requires_tree', False)
+    func_info_iter = ((index, [fi.compact(keep_node, keep_tree) for fi in func_info]
+                       if func_info is not None else None)
+                      for index, func_info in _iter_func_info_list(pycode_string_list, keep_prints=keep_prints,
+                                                                   module_level=module_level,
+                                                                   continue_on_error=continue_on_error,
+                                                                   ref_index=None if all_pairs else 0,
+                                                                   cache=_get_cache(cache, diff_method),
+                                                                   stats=stats))
+    if all_pairs:
+        func_info_list = list(func_info_iter)
+        for index, func_info in func_info_list:
+            if func_info is not None and len(func_info) == 0 and not continue_on_error:
+                raise NoFuncException(index)
+        pairs = ((index_ref, func_info_ref, index_candidate, func_info_candidate)
+                 for index_ref, func_info_ref in ((index, exclude(func_info)) for index, func_info in func_info_list
+                                                  if func_info is not None) if func_info_ref
+                 for index_candidate, func_info_candidate in func_info_list
+                 if index_candidate != index_ref and func_info_candidate is not None)
+    else:
+        first = next(func_info_iter, None)
+        if first is None:
+            return []
+        index_ref, func_info_ref = first
+        func_info_ref = exclude(func_info_ref)
+        if len(func_info_ref) == 0:
+            raise NoFuncException(index_ref)
+        pairs = ((index_ref, func_info_ref, index_candidate, func_info_candidate)
+                 for index_candidate, func_info_candidate in func_info_iter if func_info_candidate is not None)
+
+    memo = _get_memo(memo)
+    heap = []  # min heap of (plagiarism percent, -order, result), heap[0] is the k-th best pair
+    for order, (index_ref, func_info_ref, index_candidate, func_info_candidate) in enumerate(pairs):
+        if stats is not None:
+            stats.incr('candidates')
+        cutoff = heap[0][0] if len(heap) >= k else None
+        with stats.timer('match') if stats is not None else _null_context():
+            summary = _summarize_with_cutoff(func_info_ref, func_info_candidate, diff_method, cutoff, stats, memo)
+        if summary is None:
+            continue
+        item = (summary[0], -order, summary + (index_ref, index_candidate))
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heapreplace(heap, item)
+    return [result for _, _, result in sorted(heap, reverse=True)]
+
+
+class SubmissionIndex(object):
+    """
+    A persistent SQLite index of the normalized functions of past submissions, a new submission is compared to
+    all indexed submissions and only the new submission is parsed. The normalizer options are fixed when the
+    index is created, an index created by another version of the tool or python (major.minor) is rebuilt from the
+    stored code when it is opened.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path, keep_prints=False, module_level=False):
+        import sqlite3
+
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS submissions (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'name TEXT UNIQUE NOT NULL, code BLOB NOT NULL, func_info TEXT NOT NULL)')
+        version = '{}|{}|{}|{}'.format(self.FORMAT_VERSION, FingerprintCache.FORMAT_VERSION, __version__,
+                                       '.'.join(map(str, sys.version_info[:2])))
+        meta = dict(self._conn.execute('SELECT key, value FROM meta'))
+        if not meta:
+            meta = {'version': version, 'keep_prints': str(int(keep_prints)), 'module_level': str(int(module_level))}
+            self._conn.executemany('INSERT INTO meta VALUES (?, ?)', sorted(meta.items()))
+            self._conn.commit()
+        self.keep_prints = meta['keep_prints'] == '1'
+        self.module_level = meta['module_level'] == '1'
+        if meta['version'] != version:
+            if meta['version'].split('|')[0] != str(self.FORMAT_VERSION):
+                self._conn.close()
+                raise ValueError('{} is created by another index format ({}), please create a new index.'.format(
+                        path, meta['version']))
+            try:
+                self._rebuild(version)
+            except ValueError:
+                self._conn.close()
+                raise
+
+    def _rebuild(self, version):
+        """
+        Normalize the stored code of every submission again, e.g. the normalizer or the AST of python is changed.
+        """
+        rows = self._conn.execute('SELECT id, name, code FROM submissions ORDER BY id').fetchall()
+        with self._conn:
+            for submission_id, name, code in rows:
+                try:
+                    func_info = _build_func_info(zlib.decompress(code).decode('utf-8', 'replace'),
+                                                 keep_prints=self.keep_prints, module_level=self.module_level)
+                except SyntaxError as e:
+                    raise ValueError('can not rebuild {}, {} can not be parsed: {}'.format(self.path, name,
+                                                                                          e)) from e
+                self._conn.execute('UPDATE submissions SET func_info = ? WHERE id = ?',
+                                   (json.dumps([fi.get_state() for fi in func_info], separators=(',', ':')),
+                                    submission_id))
+            self._conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version,))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM submissions').fetchone()[0]
+
+    def names(self):
+        return [name for name, in self._conn.execute('SELECT name FROM submissions ORDER BY id')]
+
+    def add(self, name, code_str):
+        """
+        Parse and add a submission, the submission with the same name is replaced.
+        :return: the number of functions of the submission
+        """
+        func_info = _build_func_info(code_str, keep_prints=self.keep_prints, module_level=self.module_level)
+        code_bytes = code_str if isinstance(code_str, bytes) else code_str.encode('utf-8')
+        with self._conn:
+            self._conn.execute('DELETE FROM submissions WHERE name = ?', (name,))
+            self._conn.execute('INSERT INTO submissions (name, code, func_info) VALUES (?, ?, ?)',
+                               (name, zlib.compress(code_bytes),
+                                json.dumps([fi.get_state() for fi in func_info], separators=(',', ':'))))
+        return len(func_info)
+
+    def _iter_submissions(self):
+        for name, code, func_info in self._conn.execute('SELECT name, code, func_info FROM submissions ORDER BY id'):
+            code_lines = zlib.decompress(code).decode('utf-8', 'replace').splitlines(True)
+            yield name, [FuncInfo.from_state(state, code_lines) for state in json.loads(func_info)]
+
+    def query(self, code_str, diff_method=UnifiedDiff, workers=None, memo=DiffMemo.DEFAULT_SIZE):
+        """
+        Compare the code (referenced) to each indexed submission (candidate), the submissions are loaded one by one.
+        :param workers: the same as detect
+        :param memo: the same as detect
+        :return: generator of (name of submission, FuncDiffInfo list)
+        """
+        if getattr(diff_method, 'requires_ast', True):
+            raise ValueError('{} requires AST node, which is not indexed.'.format(diff_method.__name__))
+        _line_interner.trim()
+        func_info_ref = _build_func_info(code_str, keep_prints=self.keep_prints, module_level=self.module_level)
+        if len(func_info_ref) == 0:
+            raise NoFuncException(0)
+
+        candidates = ((name, func_info, None) for name, func_info in self._iter_submissions())
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        if workers is not None and workers > 1:
+            return _iter_detect_parallel(func_info_ref, candidates, diff_method, workers, memo=_get_memo(memo))
+        return _iter_detect_serial(func_info_ref, candidates, diff_method, memo=_get_memo(memo))
+
+
+def _func_record(func_info):
+    if func_info is None:
+        return None
+    return {'name': func_info.func_name, 'lineno': func_info.lineno, 'col_offset': func_info.col_offset,
+            'endlineno': func_info.endlineno, 'ast_lines': func_info.ast_line_count}
+
+
+def _match_record(func_diff_info):
+    return {
+        'ref_function': _func_record(func_diff_info.info_ref),
+        'candidate_function': _func_record(func_diff_info.info_candidate),
+        'percent': func_diff_info.plagiarism_percent,
+        'plagiarism_count': func_diff_info.plagiarism_count,
+        'total_count': func_diff_info.total_count,
+        'approximate': func_diff_info.approximate,
+    }
+
+
+def _is_reported(func_diff_info, line_limit, percentage_limit):
+    return func_diff_info.info_ref.ast_line_count >= line_limit and \
+        func_diff_info.plagiarism_percent >= percentage_limit
+
+
+def _result_record(candidate_name, func_ast_diff_list):
+    """
+    The json record of the FuncDiffInfo list of a candidate.
+    """
+    if any(func_diff_info.ast_parsing_error for func_diff_info in func_ast_diff_list):
+        return {'candidate': candidate_name, 'ast_parsing_error': True}
+    percent, count, total = summarize(func_ast_diff_list)
+    return {
+        'candidate': candidate_name,
+        'percent': percent,
+        'plagiarism_count': count,
+        'total_count': total,
+        'functions': [_match_record(func_diff_info) for func_diff_info in func_ast_diff_list],
+    }
+
+
+def result_records(ref_name, candidate_name, func_ast_diff_list, line_limit=0, percentage_limit=0):
+    """
+    Serialize the result of a candidate to json records: a candidate record of the summarize numbers, then a
+    function record of each function match as the command line reports.
+    :param line_limit: only the function whose AST lines >= line_limit is reported
+    :param percentage_limit: only the function whose plagiarism percentage >= percentage_limit is reported
+    :return: generator of dict
+    """
+    if any(func_diff_info.ast_parsing_error for func_diff_info in func_ast_diff_list):
+        yield {'type': 'candidate', 'ref': ref_name, 'candidate': candidate_name, 'ast_parsing_error': True}
         return
+    percent, count, total = summarize(func_ast_diff_list)
+    yield {'type': 'candidate', 'ref': ref_name, 'candidate': candidate_name, 'percent': percent,
+           'plagiarism_count': count, 'total_count': total}
+    for func_diff_info in func_ast_diff_list:
+        if _is_reported(func_diff_info, line_limit, percentage_limit):
+            record = {'type': 'function', 'ref': ref_name, 'candidate': candidate_name}
+            record.update(_match_record(func_diff_info))
+            yield record
 
-    for index, func_ast_diff_list in results:
-        print('ref: {}'.format(pycode_list[0][0]))
-        print('candidate: {}'.format(pycode_list[index][0]))
-        sum_plagiarism_percent, sum_plagiarism_count, sum_total_count = summarize(func_ast_diff_list)
-        print('{:.2f} % ({}/{}) of ref code structure is plagiarized by candidate.'.format(
-            sum_plagiarism_percent * 100,
-            sum_plagiarism_count,
-            sum_total_count,
-        ))
-        print('candidate function plagiarism details (AST lines >= {} and plagiarism percentage >= {}):'.format(
-            args.l,
-            args.p,
-        ))
-        output_count = 0
-        for func_diff_info in func_ast_diff_list:
-            if func_diff_info.ast_parsing_error:
-                print('ERR : ast parsing error for candidate file')
+
+class JsonLinesWriter(object):
+    """
+    Write the results as JSON Lines, one compact record per line. The lines are buffered and written in chunks,
+    the buffer is also flushed once a candidate is done if the last flush is older than flush_interval, so the
+    downstream tools can consume the output while the run continues.
+    """
+
+    def __init__(self, stream=None, chunk_size=1 << 16, flush_interval=1.0, line_limit=0, percentage_limit=0):
+        """
+        :param stream: a text stream, sys.stdout by default
+        :param chunk_size: flush once the buffered characters >= chunk_size
+        :param flush_interval: the max seconds of a result kept in the buffer, None means only flush by chunk_size
+        :param line_limit, percentage_limit: the function records to write, see result_records
+        """
+        self._stream = stream if stream is not None else sys.stdout
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.line_limit = line_limit
+        self.percentage_limit = percentage_limit
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+
+    def write_record(self, record):
+        line = self._encoder.encode(record) + '\n'
+        self._buffer.append(line)
+        self._buffer_size += len(line)
+        if self._buffer_size >= self.chunk_size:
+            self.flush()
+
+    def write_result(self, ref_name, candidate_name, func_ast_diff_list):
+        """
+        Write the records of result_records for a candidate.
+        """
+        for record in result_records(ref_name, candidate_name, func_ast_diff_list, self.line_limit,
+                                     self.percentage_limit):
+            self.write_record(record)
+        self._candidate_done()
+
+    def write_pair(self, plagiarism_percent, plagiarism_count, total_count, ref_name, candidate_name):
+        """
+        Write a pair record of detect_top_k.
+        """
+        self.write_record({'type': 'pair', 'ref': ref_name, 'candidate': candidate_name,
+                           'percent': plagiarism_percent, 'plagiarism_count': plagiarism_count,
+                           'total_count': total_count})
+        self._candidate_done()
+
+    def _candidate_done(self):
+        if self._buffer and self.flush_interval is not None and \
+                time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._stream.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+        self._stream.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush the buffer, the stream is not closed.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _build_compact_func_info(code_str, keep_prints=False, module_level=False):
+    return [fi.compact(keep_tree=True) for fi in _build_func_info(code_str, keep_prints=keep_prints,
+                                                                   module_level=module_level)]
+
+
+def _compare_with_corpus(code_str, corpus, diff_method_name, keep_prints=False, module_level=False):
+    """
+    Compare the code (referenced) to each submission of the corpus, run in a worker of SimilarServer.
+    :param corpus: [(name of submission, compact FuncInfo list), ...]
+    :return: [result record of each submission, ...]
+    """
+    _line_interner.trim()
+    func_info_ref = _build_func_info(code_str, keep_prints=keep_prints, module_level=module_level)
+    if len(func_info_ref) == 0:
+        raise NoFuncException(0)
+    candidates = ((name, func_info, None) for name, func_info in corpus)
+    return [_result_record(name, func_ast_diff_list)
+            for name, func_ast_diff_list in _iter_detect_serial(func_info_ref, candidates,
+                                                                DIFF_METHODS[diff_method_name],
+                                                                memo=_get_memo(DiffMemo.DEFAULT_SIZE))]
+
+
+def _init_server_worker(corpora):
+    _worker_state['corpora'] = corpora
+
+
+def _compare_in_server_worker(code_str, corpus_name, diff_method_name, keep_prints=False, module_level=False):
+    """
+    The same as _compare_with_corpus, the corpus is kept in the worker by _init_server_worker.
+    """
+    return _compare_with_corpus(code_str, _worker_state['corpora'][corpus_name], diff_method_name,
+                                keep_prints=keep_prints, module_level=module_level)
+
+
+def _parse_address(address):
+    """
+    :param address: the path of a Unix socket, or host:port of a TCP socket
+    :return: (path, None) or (host, port)
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in address:
+        return host or '127.0.0.1', int(port)
+    return address, None
+
+
+def _is_loopback(host):
+    import ipaddress
+
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+class SimilarServer(object):
+    """
+    A long-lived local daemon keeps the normalized functions of the registered corpora in memory, so a submission
+    is compared to a corpus without starting the interpreter and parsing the corpus again.
+    The protocol is JSON Lines over a Unix socket (or localhost TCP), one request and one response per line:
+        {"command": "register", "corpus": NAME, "files": {name: code, ...}}
+        {"command": "compare", "corpus": NAME, "files": {name: code, ...}, "diff_method": "unified"}
+        {"command": "corpora"}, {"command": "drop", "corpus": NAME}, {"command": "shutdown"}
+    The response is {"ok": true, ...} or {"ok": false, "error": message}. The files of a batch and the requests of
+    all clients are normalized and compared concurrently by a pool of workers processes, the corpora are sent to
+    each worker once when the pool starts, and the pool is started again by the next compare once the corpora are
+    changed. The requests are not authenticated, so a TCP socket is only bound to a loopback address.
+    """
+
+    # the max size of a request line
+    MAX_REQUEST_SIZE = 1 << 28
+
+    def __init__(self, address, workers=1, keep_prints=False, module_level=False):
+        """
+        :param workers: the number of worker processes, 0 means the number of CPUs, 1 runs in a thread
+        """
+        host, port = _parse_address(address)
+        if port is not None and not _is_loopback(host):
+            raise ValueError('{} is not a loopback address, the server only serves the local clients'.format(host))
+        self.address = address
+        self.workers = workers or os.cpu_count() or 1
+        self.keep_prints = keep_prints
+        self.module_level = module_level
+        self._corpora = {}  # {corpus name: OrderedDict of {submission name: compact FuncInfo list}}
+        self._corpora_version = 0
+        self._executor = None
+        self._executor_version = None  # the corpora version the worker processes are started with
+        self._stopped = None
+
+    def serve_forever(self, ready=None):
+        """
+        Serve until a shutdown request.
+        :param ready: called without arguments once the server is listening
+        """
+        import asyncio
+
+        asyncio.run(self._serve(ready))
+
+    @staticmethod
+    def _unlink_socket(path):
+        import stat
+
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+    async def _serve(self, ready=None):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._stopped = asyncio.Event()
+        host, port = _parse_address(self.address)
+        if port is None:
+            self._unlink_socket(host)  # a stale socket of the last run, the other files are not removed
+            server = await asyncio.start_unix_server(self._handle, path=host, limit=self.MAX_REQUEST_SIZE)
+        else:
+            server = await asyncio.start_server(self._handle, host, port, limit=self.MAX_REQUEST_SIZE)
+        if self.workers == 1:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            async with server:
+                if ready is not None:
+                    ready()
+                await self._stopped.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            if port is None:
+                self._unlink_socket(host)
+
+    def _get_executor(self, with_corpora=False):
+        """
+        :param with_corpora: the workers must have the current corpora, they are started again if the corpora are
+                             changed, otherwise the running workers are used, e.g. for normalizing
+        :return: the executor
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self.workers > 1 and (self._executor is None or
+                                 with_corpora and self._executor_version != self._corpora_version):
+            corpora = dict((name, list(corpus.items())) for name, corpus in self._corpora.items())
+            executor = self._executor
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_server_worker,
+                                                 initargs=(corpora,))
+            self._executor_version = self._corpora_version
+            if executor is not None:
+                executor.shutdown(wait=False)  # the tasks in flight are finished by the old workers
+        return self._executor
+
+    async def _handle(self, reader, writer):
+        try:
+            while not self._stopped.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self._dispatch(json.loads(line.decode('utf-8')))
+                except (ValueError, KeyError, TypeError, SyntaxError, NoFuncException) as e:
+                    response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+                writer.write(json.dumps(response, separators=(',', ':')).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _run(executor, func, *args):
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def _dispatch(self, request):
+        import asyncio
+
+        command = request['command']
+        if command == 'register':
+            corpus = self._corpora.setdefault(request['corpus'], OrderedDict())
+            names = sorted(request['files'])
+            executor = self._get_executor()
+            results = await asyncio.gather(*[self._run(executor, _build_compact_func_info, request['files'][name],
+                                                       self.keep_prints, self.module_level)
+                                             for name in names], return_exceptions=True)
+            functions, errors = {}, {}
+            for name, result in zip(names, results):
+                if isinstance(result, SyntaxError):
+                    errors[name] = 'can not parse to AST'
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    corpus[name] = result
+                    functions[name] = len(result)
+            self._corpora_version = self._corpora_version + 1
+            return {'ok': True, 'functions': functions, 'errors': errors}
+        if command == 'compare':
+            diff_method_name = request.get('diff_method', 'unified')
+            if diff_method_name not in DIFF_METHODS:
+                raise ValueError('unknown diff method {}'.format(diff_method_name))
+            if request['corpus'] not in self._corpora:
+                raise ValueError('unknown corpus {}'.format(request['corpus']))
+            if self.workers > 1:
+                func, corpus = _compare_in_server_worker, request['corpus']
+            else:
+                func, corpus = _compare_with_corpus, list(self._corpora[request['corpus']].items())
+            names = sorted(request['files'])
+            executor = self._get_executor(with_corpora=True)
+            results = await asyncio.gather(*[self._run(executor, func, request['files'][name], corpus,
+                                                       diff_method_name, self.keep_prints, self.module_level)
+                                             for name in names], return_exceptions=True)
+            files = []
+            for name, result in zip(names, results):
+                if isinstance(result, SyntaxError):
+                    files.append({'ref': name, 'error': 'can not parse to AST'})
+                elif isinstance(result, NoFuncException):
+                    files.append({'ref': name, 'error': 'can not find functions'})
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    files.append({'ref': name, 'results': result})
+            return {'ok': True, 'files': files}
+        if command == 'corpora':
+            return {'ok': True, 'corpora': dict((name, len(corpus)) for name, corpus in self._corpora.items())}
+        if command == 'drop':
+            if self._corpora.pop(request['corpus'], None) is None:
+                return {'ok': False}
+            self._corpora_version = self._corpora_version + 1
+            return {'ok': True}
+        if command == 'shutdown':
+            self._stopped.set()
+            return {'ok': True}
+        raise ValueError('unknown command {}'.format(command))
+
+
+class SimilarClient(object):
+    """
+    A blocking client of SimilarServer, one connection for many requests.
+    """
+
+    def __init__(self, address, timeout=None):
+        import socket
+
+        host, port = _parse_address(address)
+        if port is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(host)
+        else:
+            self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._sock.makefile('rb')
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, request):
+        """
+        :return: the response dict, ValueError is raised if it is not ok
+        """
+        self._sock.sendall(json.dumps(request, separators=(',', ':')).encode('utf-8') + b'\n')
+        line = self._file.readline()
+        if not line:
+            raise ValueError('the server closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok') and 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def register(self, corpus, files):
+        """
+        :param files: {name: code}
+        :return: ({name: the number of functions}, {name: error})
+        """
+        response = self.request({'command': 'register', 'corpus': corpus, 'files': files})
+        return response['functions'], response['errors']
+
+    def compare(self, corpus, files, diff_method='unified'):
+        """
+        Compare each file (referenced) to every submission of the corpus.
+        :param files: {name: code}
+        :return: [{'ref': name, 'results': [result record, ...]} or {'ref': name, 'error': message}, ...]
+        """
+        return self.request({'command': 'compare', 'corpus': corpus, 'files': files,
+                             'diff_method': diff_method})['files']
+
+    def corpora(self):
+        return self.request({'command': 'corpora'})['corpora']
+
+    def shutdown(self):
+        self.request({'command': 'shutdown'})
+
+
+def summarize(func_ast_diff_list):
+    sum_total_count = sum(func_diff_info.total_count for func_diff_info in func_ast_diff_list)
+    sum_plagiarism_count = sum(func_diff_info.plagiarism_count for func_diff_info in func_ast_diff_list)
+    if sum_total_count == 0:
+        sum_plagiarism_percent = 0
+    else:
+        sum_plagiarism_percent = sum_plagiarism_count / float(sum_total_count)
+    return sum_plagiarism_percent, sum_plagiarism_count, sum_total_count
+
+
+def _check_line_limit(value):
+    ivalue = int(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid line limit" % value)
+    return ivalue
+
+
+def _check_percentage_limit(value):
+    ivalue = float(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid percentage limit" % value)
+    return ivalue
+
+
+def _check_count(value):
+    ivalue = int(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid count" % value)
+    return ivalue
+
+
+def _check_positive_count(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError("%s is an invalid positive count" % value)
+    return ivalue
+
+
+def _check_seconds(value):
+    fvalue = float(value)
+    if fvalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid seconds" % value)
+    return fvalue
+
+
+# The number of threads reading the input files, it is also the max number of open files.
+_READ_THREADS = 8
+# The input files larger than this are mapped to memory and decoded without reading to bytes.
+_MMAP_THRESHOLD = 1024 * 1024
+
+
+def _expand_paths(args):
+    """
+    Expand the input arguments to file paths: a directory is expanded to the .py files under it (recursively),
+    a glob pattern is expanded to the matched files.
+    :raise ValueError: if a file does not exist or a pattern matches nothing
+    """
+    paths = []
+    for arg in args:
+        if not arg:
+            continue  # the blank line of @listfile
+        if os.path.isdir(arg):
+            paths.extend(sorted(glob.glob(os.path.join(glob.escape(arg), '**', '*.py'), recursive=True)))
+        elif glob.has_magic(arg):
+            matched = sorted(path for path in glob.glob(arg, recursive=True) if os.path.isfile(path))
+            if not matched:
+                raise ValueError('{} matches no file'.format(arg))
+            paths.extend(matched)
+        elif os.path.isfile(arg):
+            paths.append(arg)
+        else:
+            raise ValueError("can't open '{}'".format(arg))
+    return paths
+
+
+def _read_code(path):
+    """
+    Read a python file, decoded by its encoding declaration (PEP 263).
+    :raise OSError: can not read the file
+    :raise SyntaxError, UnicodeDecodeError: can not decode the file
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_THRESHOLD:
+            encoding, _ = tokenize.detect_encoding(f.readline)
+            f.seek(0)
+            return f.read().decode(encoding)
+        import mmap
+
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+            encoding, _ = tokenize.detect_encoding(mm.readline)
+            return str(mm, encoding)
+
+
+def _iter_read_codes(paths, threads=_READ_THREADS):
+    """
+    Read the files in a thread pool, at most threads files are open and 2 * threads files are read ahead.
+    :return: generator of (path, code or None, the error or None) in the order of paths
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque((path, executor.submit(_read_code, path)) for path in itertools.islice(paths, threads * 2))
+        while pending:
+            path, future = pending.popleft()
+            for next_path in itertools.islice(paths, 1):
+                pending.append((next_path, executor.submit(_read_code, next_path)))
+            try:
+                yield path, future.result(), None
+            except (OSError, SyntaxError, UnicodeDecodeError) as e:
+                yield path, None, e
+
+
+def _print_result(ref_name, candidate_name, func_ast_diff_list, line_limit, percentage_limit):
+    print('ref: {}'.format(ref_name))
+    print('candidate: {}'.format(candidate_name))
+    sum_plagiarism_percent, sum_plagiarism_count, sum_total_count = summarize(func_ast_diff_list)
+    print('{:.2f} % ({}/{}) of ref code structure is plagiarized by candidate.'.format(
+        sum_plagiarism_percent * 100,
+        sum_plagiarism_count,
+        sum_total_count,
+    ))
+    print('candidate function plagiarism details (AST lines >= {} and plagiarism percentage >= {}):'.format(
+        line_limit,
+        percentage_limit,
+    ))
+    output_count = 0
+    for func_diff_info in func_ast_diff_list:
+        if func_diff_info.ast_parsing_error:
+            print('ERR : ast parsing error for candidate file')
+            continue
+        if _is_reported(func_diff_info, line_limit, percentage_limit):
+            output_count = output_count + 1
+            print(func_diff_info)
+
+    if output_count == 0:
+        print('<empty results>')
+
+
+def _index_main(argv=None):
+    """
+    The index subcommands: `pycode_similar index add INDEX files` and `pycode_similar index query INDEX file`
+    """
+    parser = ArgParser(prog='pycode_similar index', fromfile_prefix_chars='@',
+                       description='Add the submissions to a persistent index, or query a file against the index')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    add_parser = subparsers.add_parser('add',
+                                       help='add the files to the index, the file with the same name is replaced')
+    add_parser.add_argument('index', help='the index file, it is created if not exists')
+    add_parser.add_argument('files', nargs='+',
+                            help='the input files, directories (the .py files under it), glob patterns '
+                                 'or @listfile (one argument per line)')
+    add_parser.add_argument('-k', '--keep-prints', action='store_true', default=False,
+                            help='keep print nodes, only used when the index is created')
+    add_parser.add_argument('-m', '--module-level', action='store_true', default=False,
+                            help='process module level nodes, only used when the index is created')
+    query_parser = subparsers.add_parser('query', help='compare the file (referenced) to every indexed file')
+    query_parser.add_argument('index', help='the index file')
+    query_parser.add_argument('file', help='the input file')
+    query_parser.add_argument('-l', type=_check_line_limit, default=4,
+                              help='if AST line of the function >= value then output detail (default: 4)')
+    query_parser.add_argument('-p', type=_check_percentage_limit, default=0.5,
+                              help='if plagiarism percentage of the function >= value then output detail '
+                                   '(default: 0.5)')
+    query_parser.add_argument('-d', '--diff-method', choices=sorted(DIFF_METHODS), default='unified',
+                              help='the diff method (default: unified)')
+    query_parser.add_argument('-j', '--jobs', type=_check_count, default=1,
+                              help='the number of worker processes, 0 means the number of CPUs (default: 1)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'add':
+        try:
+            paths = _expand_paths(args.files)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            index = SubmissionIndex(args.index, keep_prints=args.keep_prints, module_level=args.module_level)
+        except ValueError as e:
+            parser.error(str(e))
+        with index:
+            for path, code_str, error in _iter_read_codes(paths):
+                if error is not None:
+                    print('error: can not read {}: {}, skipped.'.format(path, error))
+                    continue
+                try:
+                    count = index.add(path, code_str)
+                except SyntaxError:
+                    print('error: can not parse {} to AST, skipped.'.format(path))
+                    continue
+                print('added: {} ({} functions)'.format(path, count))
+        return
+
+    if not os.path.isfile(args.index):
+        parser.error('{} is not an index file'.format(args.index))
+    try:
+        code_str = _read_code(args.file)
+    except (OSError, SyntaxError, UnicodeDecodeError) as e:
+        print('error: can not read {}: {}'.format(args.file, e))
+        return
+    try:
+        index = SubmissionIndex(args.index)
+    except ValueError as e:
+        parser.error(str(e))
+    with index:
+        try:
+            for name, func_ast_diff_list in index.query(code_str, diff_method=DIFF_METHODS[args.diff_method],
+                                                        workers=args.jobs):
+                _print_result(args.file, name, func_ast_diff_list, args.l, args.p)
+                sys.stdout.flush()
+        except NoFuncException:
+            print('error: can not find functions from {}.'.format(args.file))
+
+
+def _print_record(ref_name, record, line_limit, percentage_limit):
+    print('ref: {}'.format(ref_name))
+    print('candidate: {}'.format(record['candidate']))
+    if record.get('ast_parsing_error'):
+        print('ERR : ast parsing error for candidate file')
+        return
+    print('{:.2f} % ({}/{}) of ref code structure is plagiarized by candidate.'.format(
+        record['percent'] * 100,
+        record['plagiarism_count'],
+        record['total_count'],
+    ))
+    print('candidate function plagiarism details (AST lines >= {} and plagiarism percentage >= {}):'.format(
+        line_limit,
+        percentage_limit,
+    ))
+    output_count = 0
+    for function in record['functions']:
+        if function['ref_function']['ast_lines'] >= line_limit and function['percent'] >= percentage_limit:
+            output_count = output_count + 1
+            ref = '{name}<{lineno}:{col_offset}>'.format(**function['ref_function'])
+            if function['candidate_function'] is None:
+                print('{:<4.2}: ref {}, candidate {}'.format(float(function['percent']), ref, None))
                 continue
-            if len(func_diff_info.info_ref.func_ast_lines) >= args.l and func_diff_info.plagiarism_percent >= args.p:
-                output_count = output_count + 1
-                print(func_diff_info)
+            print('{:<4.2}: ref {}, candidate {}{}'.format(
+                float(function['percent']), ref,
+                '{name}<{lineno}:{col_offset}>'.format(**function['candidate_function']),
+                ' (approximate)' if function['approximate'] else ''))
+    if output_count == 0:
+        print('<empty results>')
 
-        if output_count == 0:
-            print('<empty results>')
 
+def _read_code_files(parser, files):
+    """
+    :return: {path: code} of the readable files, the others are reported and skipped
+    """
+    try:
+        paths = _expand_paths(files)
+    except ValueError as e:
+        parser.error(str(e))
+    code_files = {}
+    for path, code_str, error in _iter_read_codes(paths):
+        if error is not None:
+            print('error: can not read {}: {}, skipped.'.format(path, error))
+            continue
+        code_files[path] = code_str
+    return code_files
+
+
+def _serve_main(argv=None):
+    """
+    The serve subcommand: `pycode_similar serve ADDRESS`
+    """
+    parser = ArgParser(prog='pycode_similar serve',
+                       description='Run a local daemon keeps the registered corpora in memory, '
+                                   'the requests are sent by `pycode_similar client`')
+    parser.add_argument('address', help='the path of a Unix socket, or host:port of a TCP socket on a loopback address')
+    parser.add_argument('-k', '--keep-prints', action='store_true', default=False,
+                        help='keep print nodes')
+    parser.add_argument('-m', '--module-level', action='store_true', default=False,
+                        help='process module level nodes')
+    parser.add_argument('-j', '--jobs', type=_check_count, default=1,
+                        help='the number of worker processes, 0 means the number of CPUs (default: 1)')
+    args = parser.parse_args(argv)
+    try:
+        server = SimilarServer(args.address, workers=args.jobs, keep_prints=args.keep_prints,
+                               module_level=args.module_level)
+    except ValueError as e:
+        parser.error(str(e))
+    server.serve_forever(ready=lambda: print('serving on {}'.format(args.address)) or sys.stdout.flush())
+
+
+def _client_main(argv=None):
+    """
+    The client subcommands: `pycode_similar client ADDRESS register|compare CORPUS files` and
+    `pycode_similar client ADDRESS corpora|shutdown`
+    """
+    parser = ArgParser(prog='pycode_similar client', fromfile_prefix_chars='@',
+                       description='Send the requests to a `pycode_similar serve` daemon')
+    parser.add_argument('address', help='the path of a Unix socket, or host:port of a TCP socket')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    register_parser = subparsers.add_parser('register', help='add the files to the corpus, the file with the same '
+                                                             'name is replaced')
+    compare_parser = subparsers.add_parser('compare', help='compare each file (referenced) to every file of the '
+                                                           'corpus')
+    for sub_parser in (register_parser, compare_parser):
+        sub_parser.add_argument('corpus', help='the name of the corpus')
+        sub_parser.add_argument('files', nargs='+',
+                                help='the input files, directories (the .py files under it), glob patterns '
+                                     'or @listfile (one argument per line)')
+    compare_parser.add_argument('-l', type=_check_line_limit, default=4,
+                                help='if AST line of the function >= value then output detail (default: 4)')
+    compare_parser.add_argument('-p', type=_check_percentage_limit, default=0.5,
+                                help='if plagiarism percentage of the function >= value then output detail '
+                                     '(default: 0.5)')
+    compare_parser.add_argument('-d', '--diff-method', choices=sorted(DIFF_METHODS), default='unified',
+                                help='the diff method (default: unified)')
+    subparsers.add_parser('corpora', help='list the corpora and their number of files')
+    subparsers.add_parser('shutdown', help='stop the daemon')
+    args = parser.parse_args(argv)
+
+    try:
+        client = SimilarClient(args.address)
+    except OSError as e:
+        parser.error('can not connect to {}: {}'.format(args.address, e))
+    with client:
+        try:
+            if args.command == 'register':
+                functions, errors = client.register(args.corpus, _read_code_files(parser, args.files))
+                for name in sorted(functions):
+                    print('added: {} ({} functions)'.format(name, functions[name]))
+                for name in sorted(errors):
+                    print('error: can not parse {} to AST, skipped.'.format(name))
+            elif args.command == 'compare':
+                for file_result in client.compare(args.corpus, _read_code_files(parser, args.files),
+                                                  diff_method=args.diff_method):
+                    if 'error' in file_result:
+                        print('error: {} for {}.'.format(file_result['error'], file_result['ref']))
+                        continue
+                    for record in file_result['results']:
+                        _print_record(file_result['ref'], record, args.l, args.p)
+            elif args.command == 'corpora':
+                for name, count in sorted(client.corpora().items()):
+                    print('{}: {} files'.format(name, count))
+            else:
+                client.shutdown()
+        except ValueError as e:
+            print('error: {}'.format(e))
+
+
+def main():
+    """
+    The console_scripts Entry Point in setup.py, `pycode_similar index|serve|client ...` runs the subcommand
+    """
+    subcommands = {'index': _index_main, 'serve': _serve_main, 'client': _client_main}
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        return subcommands[sys.argv[1]](sys.argv[2:])
+
+    parser = ArgParser(description='A simple plagiarism detection tool for python code', fromfile_prefix_chars='@')
+    parser.add_argument('files', nargs='+',
+                        help='the input files, directories (the .py files under it), glob patterns '
+                             'or @listfile (one argument per line). First file being the reference file.')
+    parser.add_argument('-l', type=_check_line_limit, default=4,
+                        help='if AST line of the function >= value then output detail (default: 4)')
+    parser.add_argument('-p', type=_check_percentage_limit, default=0.5,
+                        help='if plagiarism percentage of the function >= value then output detail (default: 0.5)')
+    parser.add_argument('-k', '--keep-prints', action='store_true', default=False,
+                        help='keep print nodes')
+    parser.add_argument('-m', '--module-level', action='store_true', default=False,
+                        help='process module level nodes')
+    parser.add_argument('-c', '--continue-on-error', action='store_true', default=False,
+                        help='Continue on AST parsing error for candidate files. Reference code must be syntactically correct.')
+    parser.add_argument('-a', '--all-pairs', action='store_true', default=False,
+                        help='compare every file to each other, instead of the first file to the others. '
+                             'Without --top, it can not be used with -j, --lsh-bands, --prescreen, --stats, '
+                             '--memo-size and the diff budget options')
+    parser.add_argument('-d', '--diff-method', choices=sorted(DIFF_METHODS), default='unified',
+                        help='the diff method, winnow is the fastest (default: unified)')
+    parser.add_argument('-j', '--jobs', type=_check_count, default=1,
+                        help='the number of worker processes, 0 means the number of CPUs (default: 1)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='cache the normalized functions of the input files in this directory')
+    parser.add_argument('--lsh-bands', type=_check_count, default=0,
+                        help='only diff the functions found by a MinHash LSH index with this number of bands, '
+                             '0 means diff all functions (default: 0)')
+    parser.add_argument('--lsh-rows', type=_check_positive_count, default=4,
+                        help='the number of rows of each LSH band (default: 4)')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='print the runtime metrics (phase time, diff calls, slowest pairs...) to stderr')
+    parser.add_argument('-b', '--base', action='append', default=[],
+                        help='the starter code files (directories, glob patterns), the functions in them are not '
+                             'compared, can be given multiple times')
+    parser.add_argument('--memo-size', type=_check_count, default=DiffMemo.DEFAULT_SIZE,
+                        help='the max number of memoized function pair diffs, the same normalized function pair '
+                             'of different files is diffed only once, 0 means no memo (default: {})'.format(
+                                 DiffMemo.DEFAULT_SIZE))
+    parser.add_argument('--prescreen', type=_check_percentage_limit, default=None,
+                        help='only diff the function pairs whose node type histogram similarity >= this value')
+    parser.add_argument('--prescreen-metric', choices=NodeTypePrescreen.METRICS, default='cosine',
+                        help='the similarity of node type histograms for --prescreen (default: cosine)')
+    parser.add_argument('--top', type=_check_count, default=None,
+                        help='only print the summary of the TOP most similar pairs, can not be used with -j, '
+                             '--lsh-bands, --prescreen and the diff budget options')
+    parser.add_argument('--pair-work', type=_check_count, default=None,
+                        help='estimate the function pair by lower bound instead of diffing if its work '
+                             '(the product of the sizes) exceeds this value, the result is marked approximate, '
+                             'the diff budget options can not be used with -d winnow')
+    parser.add_argument('--candidate-work', type=_check_count, default=None,
+                        help='the total diff work of each candidate file, the remaining pairs are estimated')
+    parser.add_argument('--candidate-seconds', type=_check_seconds, default=None,
+                        help='the diff time of each candidate file, the remaining pairs are estimated')
+    parser.add_argument('-f', '--format', choices=('text', 'jsonl'), default='text',
+                        help='the output format, jsonl writes a json record per candidate and per reported function '
+                             'match, the errors are printed to stderr (default: text)')
+    parser.add_argument('--checkpoint', default=None,
+                        help='append the result of each finished candidate to this journal file, a restarted run '
+                             'with the same files and options only compares the candidates not in it')
+    args = parser.parse_args()
+    if args.checkpoint is not None and (args.all_pairs or args.top is not None):
+        parser.error('--checkpoint can not be used with --all-pairs or --top')
+    # the options only honored when comparing the reference file with each candidate
+    detect_options = [option for option, given in (('-j/--jobs', args.jobs != 1),
+                                                   ('--lsh-bands', args.lsh_bands),
+                                                   ('--prescreen', args.prescreen is not None),
+                                                   ('--pair-work', args.pair_work is not None),
+                                                   ('--candidate-work', args.candidate_work is not None),
+                                                   ('--candidate-seconds', args.candidate_seconds is not None))
+                      if given]
+    if args.top is not None and detect_options:
+        parser.error('{} can not be used with --top'.format(', '.join(detect_options)))
+    if args.all_pairs and args.top is None:
+        detect_options.extend(option for option, given in (('--stats', args.stats),
+                                                           ('--memo-size', args.memo_size != DiffMemo.DEFAULT_SIZE))
+                              if given)
+        if detect_options:
+            parser.error('{} can not be used with --all-pairs'.format(', '.join(detect_options)))
+    diff_method = DIFF_METHODS[args.diff_method]
+    if getattr(diff_method, 'size', None) is None or getattr(diff_method, 'lower_bound', None) is None:
+        # the diff budget is only applied to the diff methods provide size and lower_bound
+        budget_options = [option for option in detect_options
+                          if option in ('--pair-work', '--candidate-work', '--candidate-seconds')]
+        if budget_options:
+            parser.error('{} can not be used with -d {}'.format(', '.join(budget_options), args.diff_method))
+    try:
+        paths = _expand_paths(args.files)
+    except ValueError as e:
+        parser.error(str(e))
+    file_names = []  # the names of the files have been read, the undecodable files are skipped
+    stats = DetectStats() if args.stats else None
+    baseline = None
+    if args.base:
+        try:
+            baseline = Baseline((_read_code(path) for path in _expand_paths(args.base)), keep_prints=args.keep_prints,
+                                module_level=args.module_level)
+        except (ValueError, OSError, SyntaxError) as e:
+            parser.error('can not load the baseline: {}'.format(e))
+    budget = None
+    if args.pair_work is not None or args.candidate_work is not None or args.candidate_seconds is not None:
+        budget = DiffBudget(args.pair_work, args.candidate_work, args.candidate_seconds)
+    writer = JsonLinesWriter(line_limit=args.l, percentage_limit=args.p) if args.format == 'jsonl' else None
+    error_file = sys.stderr if writer is not None else sys.stdout
+
+    def _read_files(has_reference=True):
+        for path, code_str, error in _iter_read_codes(paths):
+            if error is not None:
+                if has_reference and not file_names:
+                    print('error: can not read the reference file {}: {}'.format(path, error), file=error_file)
+                    return
+                print('error: can not read {}: {}, skipped.'.format(path, error), file=error_file)
+                continue
+            file_names.append(path)
+            yield code_str
+
+    try:
+        if args.top is not None:
+            results = detect_top_k(
+                _read_files(has_reference=not args.all_pairs),
+                k=args.top,
+                diff_method=diff_method,
+                keep_prints=args.keep_prints,
+                module_level=args.module_level,
+                continue_on_error=args.continue_on_error,
+                all_pairs=args.all_pairs,
+                cache=args.cache_dir,
+                stats=stats,
+                memo=args.memo_size,
+                baseline=baseline
+            )
+            if writer is not None:
+                for plagiarism_percent, plagiarism_count, total_count, index_ref, index_candidate in results:
+                    writer.write_pair(plagiarism_percent, plagiarism_count, total_count, file_names[index_ref],
+                                      file_names[index_candidate])
+            else:
+                print('top {} most similar pairs:'.format(args.top))
+                for plagiarism_percent, plagiarism_count, total_count, index_ref, index_candidate in results:
+                    print('{:.2f} % ({}/{}): ref {}, candidate {}'.format(plagiarism_percent * 100, plagiarism_count,
+                                                                          total_count, file_names[index_ref],
+                                                                          file_names[index_candidate]))
+        elif args.all_pairs:
+            matrix = detect_all_pairs(
+                list(_read_files(has_reference=False)),
+                diff_method=diff_method,
+                keep_prints=args.keep_prints,
+                module_level=args.module_level,
+                continue_on_error=args.continue_on_error,
+                cache=args.cache_dir,
+                baseline=baseline
+            )
+            for index_ref, row in enumerate(matrix):
+                for index_candidate, func_ast_diff_list in enumerate(row):
+                    if func_ast_diff_list is None:
+                        continue
+                    if writer is not None:
+                        writer.write_result(file_names[index_ref], file_names[index_candidate], func_ast_diff_list)
+                    else:
+                        _print_result(file_names[index_ref], file_names[index_candidate], func_ast_diff_list,
+                                      args.l, args.p)
+            return
+        elif len(paths) >= 2:
+            results = iter_detect(
+                _read_files(),
+                diff_method=diff_method,
+                keep_prints=args.keep_prints,
+                module_level=args.module_level,
+                continue_on_error=args.continue_on_error,
+                workers=args.jobs,
+                cache=args.cache_dir,
+                lsh=FuncLSHIndex(bands=args.lsh_bands, rows=args.lsh_rows) if args.lsh_bands else None,
+                keep_code=False,
+                stats=stats,
+                budget=budget,
+                prescreen=(NodeTypePrescreen(args.prescreen, args.prescreen_metric)
+                           if args.prescreen is not None else None),
+                memo=args.memo_size,
+                baseline=baseline,
+                checkpoint=args.checkpoint
+            )
+            for index, func_ast_diff_list in results:
+                if writer is not None:
+                    writer.write_result(file_names[0], file_names[index], func_ast_diff_list)
+                else:
+                    _print_result(file_names[0], file_names[index], func_ast_diff_list, args.l, args.p)
+                    sys.stdout.flush()
+    except NoFuncException as ex:
+        print('error: can not find functions from {}.'.format(file_names[ex.source]), file=error_file)
+    finally:
+        if writer is not None:
+            writer.close()
+    if stats is not None:
+        print(stats, file=sys.stderr)
 
 if __name__ == '__main__':
     main()
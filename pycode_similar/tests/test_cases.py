@@ -3,7 +3,14 @@ import sys
 
 sys.path.insert(0, os.path.realpath(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))))
 
+import ast
+import io
+import contextlib
+import json
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 import pycode_similar
 
 
@@ -261,6 +268,1117 @@ print(s)?
         with self.assertRaises(pycode_similar.AstParsingException) as context:
             result = pycode_similar.detect([s1, s2], module_level=True, continue_on_error=False)
 
+    def test_all_pairs(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+"""
+        s2 = """
+def bar(b):
+    c = b + 1
+    if c > 1:
+        return True
+    return False
+"""
+        s3 = """
+def baz(c):
+    for i in range(c):
+        yield i
+"""
+        matrix = pycode_similar.detect_all_pairs([s1, s2, s3])
+        self.assertEqual(len(matrix), 3)
+        for i in range(3):
+            self.assertIsNone(matrix[i][i])
+        for i, j in ((0, 1), (0, 2), (1, 2)):
+            expected = pycode_similar.detect([[s1, s2, s3][i], [s1, s2, s3][j]])[0][1]
+            self.assertEqual(pycode_similar.summarize(matrix[i][j]), pycode_similar.summarize(expected))
+        self.assertGreater(matrix[0][1][0].plagiarism_percent, 0.5)
+        self.assertGreater(matrix[1][0][0].plagiarism_percent, 0.5)
+
+        with self.assertRaises(pycode_similar.NoFuncException):
+            pycode_similar.detect_all_pairs([s1, 'a = 1'])
+
+    def test_workers(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a):
+    for i in range(a):
+        yield i
+"""
+        s2 = """
+def baz(b):
+    for j in range(b):
+        yield j
+"""
+        s3 = """
+def qux(c):
+    if 1 < c:
+        return True
+    return False
+"""
+
+        def _result(result):
+            return [(index, [(d.info_ref.func_name, d.info_candidate.func_name, d.plagiarism_count, d.total_count)
+                             for d in func_ast_diff_list]) for index, func_ast_diff_list in result]
+
+        expected = pycode_similar.detect([s1, s2, s3, 'def ?'], continue_on_error=True)
+        result = pycode_similar.detect([s1, s2, s3, 'def ?'], continue_on_error=True, workers=2)
+        self.assertEqual(_result(expected[:2]), _result(result[:2]))
+        self.assertEqual(result[2][0], 3)
+        self.assertTrue(result[2][1][0].ast_parsing_error)
+
+    def test_cache(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+"""
+        s2 = """
+def bar(b):
+    if 1 < b:
+        return True
+    return False
+"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            expected = pycode_similar.detect([s1, s2], module_level=True)
+            self.assertEqual(pycode_similar.summarize(expected[0][1]),
+                             pycode_similar.summarize(pycode_similar.detect([s1, s2], module_level=True,
+                                                                            cache=cache_dir)[0][1]))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            with mock.patch.object(pycode_similar.ast, 'parse', side_effect=AssertionError('parsed')):
+                result = pycode_similar.detect([s1, s2], module_level=True, cache=cache_dir)
+            self.assertEqual(pycode_similar.summarize(expected[0][1]), pycode_similar.summarize(result[0][1]))
+            self.assertEqual(str(expected[0][1][0]), str(result[0][1][0]))
+            self.assertEqual(result[0][1][0].info_ref.func_code, expected[0][1][0].info_ref.func_code)
+
+            # the size of a replaced entry is not counted twice
+            cache = pycode_similar.FingerprintCache(cache_dir)
+            func_info = pycode_similar._build_func_info(s1)
+            for _ in range(3):
+                cache.put(cache.key(s1), func_info)
+            self.assertEqual(cache._size, sum(size for _, size, _ in cache._entries()))
+
+            cache = pycode_similar.FingerprintCache(cache_dir, max_size=1)
+            cache.put(cache.key(s1), [])
+            self.assertLessEqual(len(os.listdir(cache_dir)), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_ast_tokens(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+"""
+        s2 = """
+def bar(b):
+    c = b
+    if 1 < c:
+        return True
+    return False
+"""
+        fi1 = pycode_similar._build_func_info(s1)[0]
+        fi2 = pycode_similar._build_func_info(s2)[0]
+        lines1, lines2 = list(fi1.func_ast_lines), list(fi2.func_ast_lines)
+        self.assertEqual(len(fi1.func_ast_tokens), len(lines1))
+        self.assertEqual(fi1.func_ast_lines, lines1)
+        for line1, token1 in zip(lines1, fi1.func_ast_tokens):
+            for line2, token2 in zip(lines2, fi2.func_ast_tokens):
+                self.assertEqual(line1 == line2, token1 == token2)
+        self.assertEqual(fi1.func_ast, ''.join(lines1))
+        self.assertEqual(pycode_similar.UnifiedDiff.diff(fi1, fi1), 0)
+        self.assertEqual(pycode_similar.UnifiedDiff.diff_both(fi1, fi2)[0], pycode_similar.UnifiedDiff.diff(fi1, fi2))
+
+    def test_bound_pruning(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a):
+    for i in range(a):
+        yield i
+"""
+        s2 = """
+def f1(b):
+    return b
+
+def f2(b):
+    if b > 1:
+        return True
+    b = b + 1
+    return False
+
+def f3(b):
+    if b > 2:
+        return True
+    return False
+
+def f4(b):
+    if b > 3:
+        return True
+    return False
+
+def f5(b):
+    for j in range(b):
+        yield j
+        yield j
+"""
+
+        class _PlainUnifiedDiff(object):
+            diff = staticmethod(pycode_similar.UnifiedDiff.diff)
+            total = staticmethod(pycode_similar.UnifiedDiff.total)
+
+        def _result(result):
+            return [(d.info_ref.func_name, d.info_candidate.func_name, d.plagiarism_count, d.total_count)
+                    for d in result[0][1]]
+
+        result = pycode_similar.detect([s1, s2])
+        self.assertEqual(_result(result), _result(pycode_similar.detect([s1, s2], diff_method=_PlainUnifiedDiff)))
+        self.assertEqual(result[0][1][0].info_candidate.func_name, 'f3')
+
+    def test_lsh_index(self):
+        s1 = """
+def foo(a):
+    s = 0
+    for i in range(a):
+        if i % 2 == 0:
+            s += i
+    return s
+
+def bar(a, b):
+    return {'a': a, 'b': b}
+"""
+        s2 = """
+def baz(x):
+    t = 0
+    for j in range(x):
+        if j % 2 == 0:
+            t += j
+    return t
+
+def qux(x):
+    while x:
+        x = x.next
+    raise ValueError(x)
+"""
+        lsh = pycode_similar.FuncLSHIndex(bands=16, rows=2)
+        result = pycode_similar.detect([s1, s2], lsh=lsh)
+        expected = pycode_similar.detect([s1, s2])
+        func_diff_infos = dict((d.info_ref.func_name, d) for d in result[0][1])
+        self.assertEqual(func_diff_infos['foo'].info_candidate.func_name, 'baz')
+        self.assertEqual(func_diff_infos['foo'].plagiarism_percent, 1)
+        self.assertIsNone(func_diff_infos['bar'].info_candidate)
+        self.assertEqual(func_diff_infos['bar'].plagiarism_count, 0)
+        self.assertEqual(str(func_diff_infos['bar']), '0.0 : ref bar<9:0>, candidate None')
+        self.assertLessEqual(pycode_similar.summarize(result[0][1]), pycode_similar.summarize(expected[0][1]))
+
+        fi = pycode_similar._build_func_info(s1)[0]
+        self.assertEqual(lsh.signature(fi), pycode_similar.FuncLSHIndex(bands=16, rows=2).signature(fi))
+        self.assertEqual(lsh.match([lsh.band_keys(fi)], pycode_similar._build_func_info(s2)), [[0]])
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = []
+        for name, code in (('s1.py', s1), ('s2.py', s2)):
+            paths.append(os.path.join(tmp_dir, name))
+            with open(paths[-1], 'w') as f:
+                f.write(code)
+        output = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['pycode_similar', '--lsh-bands', '16', '--lsh-rows', '2', '-p', '0',
+                                             '-l', '0'] + paths), contextlib.redirect_stdout(output):
+            pycode_similar.main()
+        self.assertIn('0.0 : ref bar<9:0>, candidate None', output.getvalue())
+        with self.assertRaises(SystemExit) as cm:
+            self._run_main('--lsh-bands', '4', '--lsh-rows', '0')
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_winnow_diff(self):
+        s1 = """
+def foo(a):
+    s = 0
+    for i in range(a):
+        if i % 2 == 0:
+            s += i
+    return s
+"""
+        s2 = """
+def bar(b):
+    t = 0
+    for j in range(b):
+        if j % 2 == 0:
+            t += j
+    return t
+
+def baz(b):
+    return [b]
+"""
+        result = pycode_similar.detect([s1, s2], diff_method=pycode_similar.WinnowDiff)
+        self.assertEqual(result[0][1][0].info_candidate.func_name, 'bar')
+        self.assertEqual(result[0][1][0].plagiarism_percent, 1)
+        self.assertEqual(pycode_similar.FuncInfo._winnow([5, 3, 4, 3, 7, 1], 3), [3, 3, 1])
+        self.assertEqual(pycode_similar.FuncInfo._winnow([2], 4), [2])
+
+    def test_exact_clone(self):
+        s1 = """
+def foo(a):
+    s = 0
+    for i in range(a):
+        if i > 2:
+            s += i
+    return s
+"""
+        s2 = """
+def bar(b):
+    return b
+
+class A(object):
+    def baz(x):
+        t = 0
+        for j in range(x):
+            if 2 < j:
+                t += j
+        return t
+"""
+        fi1 = pycode_similar._build_func_info(s1)[0]
+        fi2 = pycode_similar._build_func_info(s2)[1]
+        self.assertEqual(fi1.func_hash, fi2.func_hash)
+        self.assertEqual(fi1.func_ast_lines, fi2.func_ast_lines)
+        self.assertNotEqual(fi1.func_hash, pycode_similar._build_func_info(s2)[0].func_hash)
+
+        with mock.patch.object(pycode_similar.UnifiedDiff, 'diff', side_effect=AssertionError('diffed')):
+            result = pycode_similar.detect([s1, s2])
+        self.assertEqual(result[0][1][0].info_candidate.func_name, 'A.baz')
+        self.assertEqual(result[0][1][0].plagiarism_percent, 1)
+
+    def test_single_pass_module_level(self):
+        s = """
+import os
+x = [1, 2]
+
+def foo(a):
+    def inner(b):
+        return b
+    return inner(a)
+
+if x:
+    def bar():
+        pass
+    class A(object):
+        def baz(self):
+            return self
+    y = x + 1
+print(y)
+"""
+        func_info = pycode_similar._build_func_info(s, module_level=True)
+        self.assertEqual([fi.func_name for fi in func_info], ['foo', 'inner', 'bar', 'A.baz', '__main__'])
+
+        root_node = ast.parse(s)
+        collector = pycode_similar.ModuleNodeCollector()
+        collector.visit(root_node)
+        module_node = collector.get_module_node()
+        module_node.endlineno = len(s.splitlines(True))
+        expected = pycode_similar.FuncInfo(module_node, s.splitlines(True))
+        self.assertEqual(func_info[-1].func_ast_lines, expected.func_ast_lines)
+        self.assertEqual(func_info[-1].nsubnodes, expected.nsubnodes)
+        self.assertEqual(func_info[-1].endlineno, expected.endlineno)
+        self.assertEqual(func_info[-1].func_hash, expected.func_hash)
+        self.assertEqual(func_info[0].func_ast_lines, pycode_similar._build_func_info(s)[0].func_ast_lines)
+
+    def test_linearize(self):
+        s = """
+def foo(a, b=1, *args, **kwargs):
+    \"\"\"doc\"\"\"
+    x = [i * a for i in range(b) if i % 2]
+    with open(a) as f:
+        return {k: v for k, v in kwargs.items()}, f.read(), lambda y: y ** 2
+
+def bar(x):
+    if x == 0:
+        return 0
+""" + ''.join('    elif x == %d:\n        return %d\n' % (i, i) for i in range(1, 60))
+        for func_info in pycode_similar._build_func_info(s):
+            node = func_info.func_node
+            self.assertEqual(func_info.func_ast_lines, pycode_similar.FuncInfo._dump(node).splitlines(True))
+            self.assertEqual(func_info.func_ast, pycode_similar.FuncInfo._dump(node))
+            self.assertEqual(pycode_similar.FuncInfo._linearize(node, maxline=30, maxmerged=10),
+                             pycode_similar.FuncInfo._dump(node, maxline=30, maxmerged=10).splitlines(True))
+
+    def test_tree_diff(self):
+        s1 = """
+def foo(x):
+    return x
+"""
+        s2 = """
+def bar(x):
+    return x + 1
+"""
+        fi1 = pycode_similar._build_func_info(s1)[0]
+        fi2 = pycode_similar._build_func_info(s2)[0]
+        tree = fi1.func_tree
+        self.assertEqual(tree.labels, ['arg', 'arguments', 'Name', 'Return', 'FunctionDef'])
+        self.assertEqual(list(tree.lmld), [0, 0, 2, 2, 0])
+        self.assertEqual(list(tree.keyroots), [3, 4])
+        self.assertEqual(pycode_similar.TreeDiff.diff(fi1, fi1), 0)
+        self.assertEqual(pycode_similar.TreeDiff.diff(fi1, fi2), 0)  # inserting costs 0
+        self.assertEqual(pycode_similar.TreeDiff.diff(fi2, fi1), 2)  # remove BinOp and Add
+        self.assertLessEqual(pycode_similar.TreeDiff.lower_bound(fi2, fi1), 2)
+
+        restored = pycode_similar.FuncInfo.from_state(fi2.get_state())
+        self.assertEqual(pycode_similar.TreeDiff.diff(restored, fi1), 2)
+        self.assertEqual(pycode_similar.TreeDiff.diff(fi2.compact(keep_tree=True), fi1), 2)
+        result = pycode_similar.detect([s2, s1], diff_method=pycode_similar.TreeDiff)
+        self.assertEqual(result[0][1][0].plagiarism_count, pycode_similar.TreeDiff.total(fi2, fi1) - 2)
+
+    def test_iter_detect(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+"""
+        s2 = """
+def bar(b):
+    if 1 < b:
+        return True
+    return False
+"""
+        s3 = """
+def baz(c):
+    return c
+"""
+        read = []
+
+        def _codes():
+            for code in [s1, s2, s3, "def e(:", s1]:
+                read.append(code)
+                yield code
+
+        results = pycode_similar.iter_detect(_codes(), continue_on_error=True)
+        index, func_ast_diff_list = next(results)
+        self.assertEqual(index, 1)
+        self.assertEqual(len(read), 2)  # the later candidates are not parsed yet
+        results = [(index, func_ast_diff_list)] + list(results)
+        expected = pycode_similar.detect([s1, s2, s3, "def e(:", s1], continue_on_error=True)
+        self.assertEqual([index for index, _ in results], [1, 2, 3, 4])
+        self.assertTrue(results[2][1][0].ast_parsing_error)
+        self.assertEqual([pycode_similar.summarize(r) for _, r in results],
+                         [pycode_similar.summarize(r) for _, r in expected])
+
+        lsh_results = pycode_similar.iter_detect([s1, s2, s3, s1], lsh=pycode_similar.FuncLSHIndex(bands=16, rows=2))
+        self.assertEqual([pycode_similar.summarize(r)[1] for _, r in lsh_results], [
+            pycode_similar.summarize(r)[1] for _, r in pycode_similar.detect([s1, s2, s3, s1])])
+
+    def test_submission_index(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+"""
+        s2 = """
+def bar(b):
+    if 1 < b:
+        return True
+    return False
+"""
+        s3 = """
+def baz(c):
+    return c
+"""
+        index_dir = tempfile.mkdtemp()
+        try:
+            index_path = os.path.join(index_dir, 'index.db')
+            with pycode_similar.SubmissionIndex(index_path, module_level=True) as index:
+                self.assertEqual(index.add('s2.py', s2), 2)
+                self.assertEqual(index.add('s3.py', s3), 2)
+                self.assertRaises(SyntaxError, index.add, 'bad.py', 'def e(:')
+            expected = pycode_similar.detect([s1, s2, s3], module_level=True)
+            with pycode_similar.SubmissionIndex(index_path) as index:
+                self.assertTrue(index.module_level)
+                self.assertEqual(index.names(), ['s2.py', 's3.py'])
+                with mock.patch.object(pycode_similar.ast, 'parse', wraps=ast.parse) as parse:
+                    result = list(index.query(s1))
+                self.assertEqual(parse.call_count, 1)  # only the queried code is parsed
+                self.assertEqual([name for name, _ in result], ['s2.py', 's3.py'])
+                self.assertEqual([pycode_similar.summarize(r) for _, r in result],
+                                 [pycode_similar.summarize(r) for _, r in expected])
+                self.assertEqual(str(result[0][1][0]), str(expected[0][1][0]))
+                self.assertEqual(result[0][1][0].info_candidate.func_code, expected[0][1][0].info_candidate.func_code)
+                self.assertEqual([pycode_similar.summarize(r) for _, r in index.query(s1, workers=2)],
+                                 [pycode_similar.summarize(r) for _, r in expected])
+
+                index.add('s2.py', s3)
+                self.assertEqual(len(index), 2)
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_compact_memory(self):
+        def _gen_code(seed):
+            funcs = []
+            for i in range(10):
+                body = ''.join('    v{0} = [x * {0} for x in range(a) if x % {1}]\n'
+                               '    if v{0} and a > {0}:\n'
+                               '        a += len(v{0})\n'.format(j, j + seed + 2) for j in range(8))
+                funcs.append('def f{}(a, b=1):\n{}    return a\n'.format(i, body))
+            return '\n'.join(funcs)
+
+        full = [pycode_similar._build_func_info(_gen_code(seed)) for seed in range(4)]
+        compact = [[fi.compact() for fi in func_info] for func_info in full]
+        for func_info, compact_func_info in zip(full, compact):
+            for fi, compact_fi in zip(func_info, compact_func_info):
+                self.assertFalse(hasattr(compact_fi, '__dict__'))
+                # only the hash, the interned AST lines and the tokens are kept, no AST node and no source code
+                self.assertIsNone(compact_fi.func_node)
+                self.assertIsNone(compact_fi._code_lines)
+                self.assertIsNone(compact_fi._func_code)
+                self.assertIsNone(compact_fi._func_ast)
+                self.assertEqual(compact_fi.func_hash, fi.func_hash)
+                self.assertEqual(compact_fi.func_ast_tokens, fi.func_ast_tokens)
+                self.assertEqual(str(compact_fi), str(fi))
+                self.assertFalse(any(isinstance(value, ast.AST)
+                                     for value in compact_fi.__getstate__().values()))
+        # the same AST lines of all functions share one string
+        self.assertIs(compact[0][0].func_ast_lines[0], compact[1][0].func_ast_lines[0])
+        self.assertEqual(full[0][0].compact(keep_code=True).func_code, full[0][0].func_code)
+
+    def test_stats(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a, b):
+    return {'a': a, 'b': b}
+"""
+        s2 = """
+def baz(b):
+    if 1 < b:
+        return True
+    return False
+
+def qux(x):
+    while x:
+        x = x.next
+    raise ValueError(x)
+"""
+        stats = pycode_similar.DetectStats(top=2)
+        result = pycode_similar.detect([s1, s2, s1, "def e(:"], stats=stats, continue_on_error=True)
+        self.assertEqual([pycode_similar.summarize(r) for _, r in result], [
+            pycode_similar.summarize(r) for _, r in pycode_similar.detect([s1, s2, s1, "def e(:"],
+                                                                          continue_on_error=True)])
+        self.assertEqual(set(stats.phases), {'parse', 'normalize', 'dump', 'match'})
+        self.assertEqual(stats.counters['candidates'], 3)
+        self.assertEqual(stats.counters['functions'], 6)
+        self.assertEqual(stats.counters['syntax_errors'], 1)
+        self.assertEqual(stats.counters['exact_matches'], 3)  # foo -> baz, foo -> foo and bar -> bar
+        # the candidate functions of bar -> s2 are either diffed or pruned
+        self.assertEqual(stats.counters['diff_calls'] + stats.counters['pruned_by_length'] +
+                         stats.counters['pruned_by_bound'], 2)
+        self.assertEqual(len(stats.slowest_pairs), stats.counters['diff_calls'])
+        self.assertEqual(stats.largest_functions[0][1], '1:qux<7:0>')
+        self.assertEqual(json.loads(json.dumps(stats.as_dict()))['counters'], dict(stats.counters))
+        self.assertIn('diff_calls', str(stats))
+
+        parallel_stats = pycode_similar.DetectStats(top=2)
+        pycode_similar.detect([s1, s2, s1, "def e(:"], stats=parallel_stats, continue_on_error=True, workers=2)
+        self.assertEqual(parallel_stats.counters, stats.counters)
+
+    def test_read_inputs(self):
+        input_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(input_dir, 'sub'))
+            files = {
+                'a.py': b'def f(a):\n    return a\n',
+                'sub/b.py': b'# -*- coding: latin-1 -*-\ndef g(b):\n    return "\xe9"\n',
+                'sub/c.py': b'\xff\xfe def h(): pass\n',
+                'sub/d.txt': b'not python',
+            }
+            for name, content in files.items():
+                with open(os.path.join(input_dir, name), 'wb') as f:
+                    f.write(content)
+            path = lambda name: os.path.join(input_dir, name)
+
+            self.assertEqual(pycode_similar._expand_paths([path('a.py'), path('sub'), '']),
+                             [path('a.py'), path('sub/b.py'), path('sub/c.py')])
+            self.assertEqual(pycode_similar._expand_paths([os.path.join(input_dir, '**', '*.py')]),
+                             [path('a.py'), path('sub/b.py'), path('sub/c.py')])
+            self.assertRaises(ValueError, pycode_similar._expand_paths, [path('none.py')])
+            self.assertRaises(ValueError, pycode_similar._expand_paths, [path('*.pyx')])
+
+            self.assertEqual(pycode_similar._read_code(path('sub/b.py')).splitlines()[2], '    return "\xe9"')
+            with mock.patch.object(pycode_similar, '_MMAP_THRESHOLD', 0):
+                self.assertEqual(pycode_similar._read_code(path('sub/b.py')),
+                                 files['sub/b.py'].decode('latin-1'))
+
+            result = list(pycode_similar._iter_read_codes([path('a.py'), path('sub/c.py'), path('none.py'),
+                                                           path('sub/b.py')], threads=1))
+            self.assertEqual([p for p, _, _ in result], [path('a.py'), path('sub/c.py'), path('none.py'),
+                                                         path('sub/b.py')])
+            self.assertEqual(result[0][1:], (files['a.py'].decode('utf-8'), None))
+            self.assertIsInstance(result[1][2], SyntaxError)
+            self.assertIsInstance(result[2][2], OSError)
+            self.assertIsNone(result[3][2])
+        finally:
+            shutil.rmtree(input_dir)
+
+    def test_diff_budget(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a, b):
+    c = a + b
+    for i in range(c):
+        print(i)
+    return {'a': a, 'b': b}
+"""
+        s2 = """
+def baz(b):
+    if 1 < b:
+        return True
+    return False
+
+def qux(x, y):
+    z = x - y
+    while z:
+        z -= 1
+    return [x, y]
+"""
+        exact = pycode_similar.detect([s1, s2])[0][1]
+        self.assertFalse(any(info.approximate for info in exact))
+
+        stats = pycode_similar.DetectStats()
+        budget = pycode_similar.DiffBudget(pair_work=1)
+        estimated = pycode_similar.detect([s1, s2], budget=budget, stats=stats)[0][1]
+        # foo is matched by hash, bar -> qux is estimated by its lower bound which never loses to the real diff
+        self.assertEqual([info.approximate for info in estimated], [False, True])
+        self.assertEqual(stats.counters['diff_calls'], 0)
+        self.assertGreater(stats.counters['approximate_pairs'], 0)
+        self.assertEqual(estimated[0].plagiarism_count, exact[0].plagiarism_count)
+        self.assertGreaterEqual(estimated[1].plagiarism_count, exact[1].plagiarism_count)
+        self.assertIn('(approximate)', str(estimated[1]))
+        self.assertEqual([str(info) for info in pycode_similar.detect([s1, s2], budget=budget, workers=2)[0][1]],
+                         [str(info) for info in estimated])
+
+        # a large enough budget is the same as no budget
+        budget = pycode_similar.DiffBudget(pair_work=10 ** 9, candidate_work=10 ** 9, candidate_seconds=60)
+        self.assertEqual([str(info) for info in pycode_similar.detect([s1, s2], budget=budget)[0][1]],
+                         [str(info) for info in exact])
+
+    def test_detect_top_k(self):
+        base = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a, b):
+    c = a + b
+    for i in range(c):
+        print(i)
+    return {'a': a, 'b': b}
+"""
+        codes = [base,
+                 base.replace('    return False', '    a = a - 1\n    return False'),
+                 base.replace('c = a + b', 'c = a * b + 1'),
+                 base,
+                 "def e(:",
+                 "def qux(x):\n    while x:\n        x = x.next\n    raise ValueError(x)\n"]
+        expected = sorted(((pycode_similar.summarize(r)[0], index) for index, r in
+                           pycode_similar.detect(codes, continue_on_error=True) if r[0].info_ref is not None),
+                          key=lambda item: (-item[0], item[1]))
+        stats = pycode_similar.DetectStats()
+        top = pycode_similar.detect_top_k(iter(codes), k=2, continue_on_error=True, stats=stats)
+        self.assertEqual([(percent, index) for percent, _, _, _, index in top], expected[:2])
+        self.assertEqual(top[0][1:], (top[0][2], top[0][2], 0, 3))  # the identical code is the best
+        self.assertGreater(stats.counters['pruned_by_top_k'], 0)
+        self.assertEqual(pycode_similar.detect_top_k(codes, k=0, continue_on_error=True), [])
+
+        top = pycode_similar.detect_top_k(codes[:4], k=3, all_pairs=True)
+        self.assertEqual([(index_ref, index_candidate) for _, _, _, index_ref, index_candidate in top],
+                         [(0, 3), (3, 0), (0, 1)])
+
+    def test_node_type_prescreen(self):
+        s1 = """
+def foo(a):
+    if a > 1:
+        return True
+    return False
+
+def bar(a, b):
+    c = a + b
+    for i in range(c):
+        print(i)
+    return {'a': a, 'b': b}
+"""
+        s2 = """
+def baz(b):
+    if 1 < b:
+        return None
+    return b
+
+def qux(x, y):
+    z = x - y
+    while z:
+        z -= 1
+    return [x, y]
+
+def nested(x):
+    def inner(y):
+        return y[0]
+    return inner
+"""
+        # the node types are only counted when asked, and compact does not carry them or build the tree
+        module_info = pycode_similar._build_func_info(s2, module_level=True)[-1].compact()
+        self.assertIsNone(module_info._node_type_counts)
+        self.assertIsNone(module_info._func_tree)
+        func_info = pycode_similar._build_func_info(s2)
+        self.assertIsNone(func_info[0]._node_type_counts)
+        self.assertIsNone(func_info[0].compact()._node_type_counts)
+        self.assertIsNone(func_info[0]._func_tree)
+        for fi in func_info:
+            self.assertEqual(fi.node_type_counts, fi.func_tree.label_counts)
+        self.assertEqual(func_info[0].compact(keep_node_type_counts=True)._node_type_counts,
+                         func_info[0].node_type_counts)
+        self.assertEqual(func_info[2].node_type_counts['FunctionDef'], 2)
+        self.assertEqual(pycode_similar.FuncInfo.from_state(func_info[2].get_state()).node_type_counts,
+                         func_info[2].node_type_counts)
+
+        for metric in pycode_similar.NodeTypePrescreen.METRICS:
+            prescreen = pycode_similar.NodeTypePrescreen(0.0, metric, use_numpy=False)
+            similarities = prescreen.similarities(prescreen.prepare(func_info[:2]), func_info)
+            self.assertAlmostEqual(similarities[0][0], 1.0)
+            self.assertLess(similarities[0][1], 1.0)
+            self.assertGreater(similarities[0][1], 0.0)
+            if pycode_similar._import_numpy() is not None:
+                prescreen = pycode_similar.NodeTypePrescreen(0.0, metric, use_numpy=True)
+                for row, expected in zip(prescreen.similarities(prescreen.prepare(func_info[:2]), func_info),
+                                         similarities):
+                    for value, expected_value in zip(row, expected):
+                        self.assertAlmostEqual(value, expected_value)
+        self.assertRaises(ValueError, pycode_similar.NodeTypePrescreen, 0.5, 'l2')
+
+        # a zero floor diffs every pair, a high floor rules out the dissimilar pairs
+        result = pycode_similar.detect([s1, s2])
+        prescreen = pycode_similar.NodeTypePrescreen(0.0, use_numpy=False)
+        self.assertEqual([str(info) for info in pycode_similar.detect([s1, s2], prescreen=prescreen)[0][1]],
+                         [str(info) for info in result[0][1]])
+        stats = pycode_similar.DetectStats()
+        prescreen = pycode_similar.NodeTypePrescreen(0.99, use_numpy=False)
+        result = pycode_similar.detect([s1, s2], prescreen=prescreen, stats=stats)
+        self.assertEqual(stats.counters['prescreened_pairs'], 8)  # inner is a function too
+        self.assertEqual(stats.counters['diff_calls'], 0)
+        self.assertEqual(pycode_similar.summarize(result[0][1])[1], 0)
+        # the referenced functions without any candidate passed the prescreen are still printable
+        self.assertEqual(sorted(str(info) for info in result[0][1]),
+                         ['0.0 : ref bar<7:0>, candidate None', '0.0 : ref foo<2:0>, candidate None'])
+
+    def test_diff_memo(self):
+        template = """
+def helper(a, b):
+    c = a + b
+    for i in range(c):
+        a = a * i
+    return a
+"""
+        s1 = template + "\ndef solve(x):\n    if x > 1:\n        return helper(x, 1)\n    return x\n"
+        s2 = template.replace('a * i', 'a * i + 1') + "\ndef answer(y):\n    while y:\n        y -= 1\n    return y\n"
+        codes = [s1, s2, s2, s2]
+        expected = pycode_similar.detect(codes, memo=0)
+        stats = pycode_similar.DetectStats()
+        memo = pycode_similar.DiffMemo(max_size=8)
+        result = pycode_similar.detect(codes, stats=stats, memo=memo)
+        self.assertEqual([[str(info) for info in r] for _, r in result],
+                         [[str(info) for info in r] for _, r in expected])
+        self.assertGreater(stats.counters['memo_hits'], 0)
+        self.assertEqual(len(memo), stats.counters['diff_calls'])  # every diffed pair is memoized once
+
+        memo = pycode_similar.DiffMemo(max_size=2)
+        memo.put('a', 1)
+        memo.put('b', 2)
+        self.assertEqual(memo.get('a'), 1)
+        memo.put('c', 3)  # b is the least recently used
+        self.assertIsNone(memo.get('b'))
+        self.assertEqual((memo.get('a'), memo.get('c')), (1, 3))
+        self.assertIsNone(pycode_similar._get_memo(0))
+
+    def test_baseline(self):
+        starter = """
+def read_input(path):
+    with open(path) as f:
+        return [int(line) for line in f]
+
+def write_output(path, values):
+    with open(path, 'w') as f:
+        for value in values:
+            f.write(str(value))
+"""
+        solution = """
+def solve(values):
+    total = 0
+    for value in values:
+        if value > 0:
+            total += value
+    return total
+"""
+        other = """
+def answer(values):
+    return max(values)
+"""
+        baseline = pycode_similar.Baseline([starter])
+        self.assertEqual(len(baseline), 2)
+        func_info = pycode_similar._build_func_info(starter.replace('f.write(str(value))', 'f.write(str(value) + "")') +
+                                                    solution)
+        self.assertEqual([fi.func_name for fi in baseline.exclude(func_info)], ['solve'])
+        self.assertEqual([fi.func_name for fi in pycode_similar.Baseline([starter], coverage=None).exclude(func_info)],
+                         ['write_output', 'solve'])
+
+        stats = pycode_similar.DetectStats()
+        result = pycode_similar.detect([starter + solution, starter + other], baseline=baseline, stats=stats)
+        self.assertEqual([info.info_ref.func_name for info in result[0][1]], ['solve'])
+        self.assertEqual(stats.counters['baseline_functions'], 2)
+        # the starter code is not counted by summarize
+        self.assertEqual(pycode_similar.summarize(result[0][1]), pycode_similar.summarize(
+            pycode_similar.detect([solution, starter + other])[0][1]))
+        self.assertRaises(pycode_similar.NoFuncException, pycode_similar.detect, [starter, solution],
+                          baseline=baseline)
+
+        top = pycode_similar.detect_top_k([starter + solution, starter + other], baseline=baseline)
+        self.assertEqual(top[0][0], pycode_similar.summarize(result[0][1])[0])
+        matrix = pycode_similar.detect_all_pairs([starter + solution, starter + other], baseline=baseline)
+        self.assertEqual([info.info_ref.func_name for info in matrix[0][1]], ['solve'])
+        self.assertEqual([info.info_ref.func_name for info in matrix[1][0]], ['answer'])
+
+    def _start_server(self, **kwargs):
+        import threading
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        address = os.path.join(tmp_dir, 'server.sock')
+        server = pycode_similar.SimilarServer(address, **kwargs)
+        ready = threading.Event()
+        thread = threading.Thread(target=server.serve_forever, args=(ready.set,))
+        thread.start()
+        self.assertTrue(ready.wait(10))
+        return address, thread
+
+    def test_server(self):
+        ref = """
+def add(a, b):
+    total = a + b
+    if total > 10:
+        return total - 10
+    return total
+"""
+        corpus = {
+            'a.py': ref.replace('total', 's'),
+            'b.py': 'def mul(x, y):\n    return x * y\n',
+            'c.py': 'def broken(:\n',
+        }
+        address, thread = self._start_server()
+        with pycode_similar.SimilarClient(address) as client:
+            self.assertEqual(client.register('hw1', corpus), ({'a.py': 1, 'b.py': 1}, {'c.py': 'can not parse to AST'}))
+            self.assertEqual(client.corpora(), {'hw1': 2})
+            files = client.compare('hw1', {'ref.py': ref, 'bad.py': 'x = 1\n'})
+            self.assertEqual(files[0], {'ref': 'bad.py', 'error': 'can not find functions'})
+            results = files[1]['results']
+            self.assertEqual([record['candidate'] for record in results], ['a.py', 'b.py'])
+            expected = pycode_similar.detect([ref, corpus['a.py'], corpus['b.py']])
+            for record, (_, func_ast_diff_list) in zip(results, expected):
+                self.assertEqual((record['percent'], record['plagiarism_count'], record['total_count']),
+                                 pycode_similar.summarize(func_ast_diff_list))
+            self.assertEqual(results[0]['functions'][0]['ref_function']['name'], 'add')
+            self.assertEqual(results[0]['functions'][0]['candidate_function']['lineno'], 2)
+            self.assertRaises(ValueError, client.compare, 'hw2', {'ref.py': ref})
+            client.shutdown()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(address))
+
+        # a file which is not a socket is not removed
+        with open(address, 'w') as f:
+            f.write('data')
+        self.assertRaises(OSError, pycode_similar.SimilarServer(address).serve_forever)
+        with open(address) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_server_workers(self):
+        import concurrent.futures
+
+        tests_dir = os.path.dirname(os.path.abspath(__file__))
+        codes = []
+        for name in ('original_version.py', 'test_cases.py'):
+            with open(os.path.join(tests_dir, name)) as f:
+                codes.append(f.read())
+        corpus = {'a.py': codes[1], 'b.py': codes[0].replace('return', 'pass; return'),
+                  'c.py': codes[1].replace('self.', 'self.x.'), 'd.py': codes[0].replace(' == ', ' != ')}
+        # the worker processes start with an empty table, and each of them interns the lines in its own order
+        pycode_similar._line_interner.trim(0)
+        with mock.patch.object(concurrent.futures, 'ProcessPoolExecutor',
+                               wraps=concurrent.futures.ProcessPoolExecutor) as pool:
+            address, thread = self._start_server(workers=2)
+            with pycode_similar.SimilarClient(address) as client:
+                client.register('hw1', dict(list(corpus.items())[:2]))
+                client.register('hw1', dict(list(corpus.items())[2:]))
+                files = client.compare('hw1', {'ref1.py': codes[0], 'ref2.py': codes[0]})
+                self.assertEqual(client.compare('hw1', {'ref1.py': codes[0]})[0]['results'], files[0]['results'])
+                client.shutdown()
+            thread.join(10)
+        # the pool of the first register is started again by the first compare only
+        self.assertEqual(pool.call_count, 2)
+        names = sorted(corpus)
+        expected = pycode_similar.detect([codes[0]] + [corpus[name] for name in names])
+        self.assertEqual(files[0]['results'], files[1]['results'])
+        results = files[0]['results']
+        self.assertEqual([record['candidate'] for record in results], names)
+        for record, (_, func_ast_diff_list) in zip(results, expected):
+            self.assertEqual((record['percent'], record['plagiarism_count'], record['total_count']),
+                             pycode_similar.summarize(func_ast_diff_list))
+            self.assertEqual([(function['ref_function']['name'], function['candidate_function']['name'],
+                               function['percent']) for function in record['functions']],
+                             [(info.info_ref.func_name, info.info_candidate.func_name, info.plagiarism_percent)
+                              for info in func_ast_diff_list])
+
+    def test_json_lines_writer(self):
+        ref = """
+def add(a, b):
+    total = a + b
+    if total > 10:
+        return total - 10
+    return total
+
+def neg(a):
+    return -a
+"""
+        candidate = ref.replace('total', 's')
+        (_, func_ast_diff_list), = pycode_similar.detect([ref, candidate])
+        records = list(pycode_similar.result_records('ref.py', 'candidate.py', func_ast_diff_list, line_limit=14))
+        self.assertEqual([record['type'] for record in records], ['candidate', 'function'])
+        self.assertEqual((records[0]['percent'], records[0]['plagiarism_count'], records[0]['total_count']),
+                         pycode_similar.summarize(func_ast_diff_list))
+        self.assertEqual(records[1]['ref_function']['name'], 'add')
+        self.assertEqual((records[1]['candidate_function']['lineno'], records[1]['candidate_function']['endlineno']),
+                         (2, 6))
+        self.assertEqual(records[1]['percent'], 1)
+
+        stream = io.StringIO()
+        writer = pycode_similar.JsonLinesWriter(stream, chunk_size=1 << 20, flush_interval=None, line_limit=14)
+        writer.write_result('ref.py', 'candidate.py', func_ast_diff_list)
+        self.assertEqual(stream.getvalue(), '')  # buffered until the chunk is full
+        with writer:
+            writer.write_pair(1.0, 3, 3, 'ref.py', 'candidate.py')
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines[:2]], records)
+        self.assertEqual(json.loads(lines[2]), {'type': 'pair', 'ref': 'ref.py', 'candidate': 'candidate.py',
+                                                'percent': 1.0, 'plagiarism_count': 3, 'total_count': 3})
+
+        stream = io.StringIO()
+        writer = pycode_similar.JsonLinesWriter(stream, chunk_size=1)
+        writer.write_result('ref.py', 'candidate.py', pycode_similar._ast_error_func_diff_list())
+        self.assertEqual(json.loads(stream.getvalue()), {'type': 'candidate', 'ref': 'ref.py',
+                                                         'candidate': 'candidate.py', 'ast_parsing_error': True})
+
+    def test_checkpoint(self):
+        ref = """
+def add(a, b):
+    total = a + b
+    if total > 10:
+        return total - 10
+    return total
+
+def neg(a):
+    return -a
+"""
+        codes = [ref, ref.replace('total', 's'), 'def mul(x, y):\n    return x * y\n', 'def broken(:\n', ref]
+
+        def _summary(results):
+            return [(index, pycode_similar.summarize(func_ast_diff_list),
+                     [(info.info_candidate.func_name, info.info_candidate.lineno, info.info_candidate.func_ast_lines,
+                       info.info_candidate.func_code, str(info)) if info.info_candidate else None
+                      for info in func_ast_diff_list])
+                    for index, func_ast_diff_list in results]
+
+        expected = _summary(pycode_similar.detect(codes, continue_on_error=True))
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'journal.jsonl')
+        results = pycode_similar.iter_detect(codes, continue_on_error=True, checkpoint=path)
+        done = [next(results), next(results)]
+        results.close()  # interrupted
+        with open(path, 'a') as f:
+            f.write('{"version": 2, "tag"')  # the record cut off by a crash
+        self.assertEqual(_summary(done), expected[:2])
+
+        stats = pycode_similar.DetectStats()
+        with pycode_similar.CheckpointJournal(path) as journal:
+            self.assertEqual(len(journal), 2)
+            self.assertEqual(_summary(pycode_similar.detect(codes, continue_on_error=True, checkpoint=journal,
+                                                            stats=stats)), expected)
+        self.assertEqual(stats.counters['restored_candidates'], 2)
+        self.assertEqual(stats.counters['candidates'], 2)
+        self.assertEqual(len(pycode_similar.CheckpointJournal(path)), 4)
+        with open(path) as f:
+            self.assertNotIn('ast_lines', f.read())  # only the count of AST lines is journaled
+        # without the code, the restored FuncInfo is for reporting only
+        restored = dict(pycode_similar.iter_detect(codes, continue_on_error=True, checkpoint=path, keep_code=False))
+        info = restored[4][0]
+        self.assertEqual((info.info_candidate.ast_line_count, str(info)), (len(info.info_ref.func_ast_lines),
+                                                                           '1.0 : ref add<2:0>, candidate add<2:0>'))
+        self.assertRaises(ValueError, lambda: info.info_candidate.func_ast_lines)
+        self.assertRaises(ValueError, lambda: info.info_candidate.func_tree)
+
+        # the records of other options or other referenced code are not used
+        stats = pycode_similar.DetectStats()
+        pycode_similar.detect(codes, continue_on_error=True, diff_method=pycode_similar.WinnowDiff, checkpoint=path,
+                              stats=stats)
+        self.assertNotIn('restored_candidates', stats.counters)
+        stats = pycode_similar.DetectStats()
+        pycode_similar.detect([codes[0] + '\ndef one():\n    return 1\n'] + codes[1:], continue_on_error=True,
+                              checkpoint=path, stats=stats)
+        self.assertNotIn('restored_candidates', stats.counters)
+
+    def test_line_interner_trim(self):
+        import pickle
+
+        code = """
+def add(a, b):
+    total = a + b
+    if total > 10:
+        return total - 10
+    return total
+"""
+        fi1 = pycode_similar._build_func_info(code)[0].compact()
+        # the tokens are not pickled, they are interned again by the process unpickles them
+        fi2 = pickle.loads(pickle.dumps(fi1))
+        self.assertIsNone(fi2._func_ast_tokens)
+        self.assertEqual(fi2.func_ast_tokens, fi1.func_ast_tokens)
+
+        interner = pycode_similar._line_interner
+        generation = interner.generation
+        interner.trim(len(interner))
+        self.assertEqual(interner.generation, generation)
+        interner.trim(0)
+        self.assertEqual((interner.generation, len(interner)), (generation + 1, 0))
+        fi3 = pycode_similar._build_func_info(code.replace('10', '20'))[0].compact()
+        self.assertEqual(fi1.func_ast_tokens, fi3.func_ast_tokens)
+        self.assertEqual(pycode_similar.UnifiedDiff.diff(fi1, fi3), 0)
+
+    def test_print_record(self):
+        record = {'candidate': 'candidate.py', 'percent': 0, 'plagiarism_count': 0, 'total_count': 9, 'functions': [
+            {'ref_function': {'name': 'add', 'lineno': 2, 'col_offset': 0, 'endlineno': 6, 'ast_lines': 15},
+             'candidate_function': None, 'percent': 0, 'plagiarism_count': 0, 'total_count': 9, 'approximate': False},
+            {'ref_function': {'name': 'neg', 'lineno': 8, 'col_offset': 0, 'endlineno': 9, 'ast_lines': 12},
+             'candidate_function': {'name': 'minus', 'lineno': 1, 'col_offset': 0, 'endlineno': 2, 'ast_lines': 12},
+             'percent': 1, 'plagiarism_count': 12, 'total_count': 12, 'approximate': True},
+        ]}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            pycode_similar._print_record('ref.py', record, 0, 0)
+        self.assertEqual(output.getvalue().splitlines()[-2:],
+                         ['0.0 : ref add<2:0>, candidate None',
+                          '1.0 : ref neg<8:0>, candidate minus<1:0> (approximate)'])
+
+    def _run_main(self, *args):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = []
+        for name, code in (('s1.py', 'def foo(a):\n    return a + 1\n'), ('s2.py', 'def bar(b):\n    return b + 1\n')):
+            paths.append(os.path.join(tmp_dir, name))
+            with open(paths[-1], 'w') as f:
+                f.write(code)
+        output, error = io.StringIO(), io.StringIO()
+        with mock.patch.object(sys, 'argv', ['pycode_similar'] + list(args) + paths), \
+                contextlib.redirect_stdout(output), contextlib.redirect_stderr(error):
+            pycode_similar.main()
+        return output.getvalue(), error.getvalue()
+
+    def test_top_k_options(self):
+        output, _ = self._run_main('--top', '1')
+        self.assertIn('100.00 % (12/12)', output)
+        for option in (['-j', '2'], ['--lsh-bands', '4'], ['--prescreen', '0.5'], ['--pair-work', '10'],
+                       ['--candidate-work', '10'], ['--candidate-seconds', '1']):
+            with self.assertRaises(SystemExit) as cm:
+                self._run_main('--top', '1', *option)
+            self.assertEqual(cm.exception.code, 2)
+
+    def test_all_pairs_options(self):
+        output, _ = self._run_main('--all-pairs', '-p', '0', '-l', '0')
+        self.assertIn('ref foo<1:0>, candidate bar<1:0>', output)
+        for option in (['-j', '2'], ['--lsh-bands', '4'], ['--prescreen', '0.5'], ['--stats'], ['--memo-size', '0'],
+                       ['--pair-work', '10'], ['--candidate-work', '10'], ['--candidate-seconds', '1']):
+            with self.assertRaises(SystemExit) as cm:
+                self._run_main('--all-pairs', *option)
+            self.assertEqual(cm.exception.code, 2)
+        # detect_top_k honors --stats and --memo-size
+        output, error = self._run_main('--all-pairs', '--top', '1', '--stats', '--memo-size', '0')
+        self.assertIn('100.00 %', output)
+        self.assertTrue(error)
+
+    def test_submission_index_rebuild(self):
+        import sqlite3
+
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_path = os.path.join(index_dir, 'index.db')
+        code = 'def foo(a):\n    if a > 1:\n        return True\n    return False\n'
+        with pycode_similar.SubmissionIndex(index_path, module_level=True) as index:
+            index.add('s1.py', code)
+        expected = [pycode_similar.summarize(r) for _, r in pycode_similar.detect([code, code], module_level=True)]
+
+        def _set_version(version):
+            conn = sqlite3.connect(index_path)
+            with conn:
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version,))
+                conn.execute("UPDATE submissions SET func_info = '[]'")
+            conn.close()
+
+        # the index of another python or tool version is rebuilt from the stored code
+        _set_version('{}|0|0.0|3.11.6'.format(pycode_similar.SubmissionIndex.FORMAT_VERSION))
+        with pycode_similar.SubmissionIndex(index_path) as index:
+            self.assertTrue(index.module_level)
+            self.assertEqual([pycode_similar.summarize(r) for _, r in index.query(code)], expected)
+        with pycode_similar.SubmissionIndex(index_path) as index:
+            self.assertEqual([pycode_similar.summarize(r) for _, r in index.query(code)], expected)
+        # the index of another format can not be rebuilt
+        _set_version('0|0|0.0|3.11')
+        self.assertRaises(ValueError, pycode_similar.SubmissionIndex, index_path)
+        with self.assertRaises(SystemExit) as cm:
+            with contextlib.redirect_stderr(io.StringIO()):
+                pycode_similar._index_main(['query', index_path, __file__])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_diff_budget_options(self):
+        output, _ = self._run_main('--pair-work', '10', '-p', '0', '-l', '0')
+        self.assertIn('ref foo<1:0>, candidate bar<1:0>', output)
+        for option in (['--pair-work', '10'], ['--candidate-work', '10'], ['--candidate-seconds', '1']):
+            with self.assertRaises(SystemExit) as cm:
+                self._run_main('-d', 'winnow', *option)
+            self.assertEqual(cm.exception.code, 2)
+
+    def test_server_loopback(self):
+        for address in ('0.0.0.0:8000', '192.168.1.1:8000', 'example.com:8000'):
+            self.assertRaises(ValueError, pycode_similar.SimilarServer, address)
+        for address in (':8000', '127.0.0.1:8000', 'localhost:8000', '::1:8000', '/tmp/server.sock'):
+            pycode_similar.SimilarServer(address)
+        with self.assertRaises(SystemExit) as cm:
+            with contextlib.redirect_stderr(io.StringIO()):
+                pycode_similar._serve_main(['0.0.0.0:8000'])
+        self.assertEqual(cm.exception.code, 2)
+
 
 if __name__ == "__main__":
     #     import sys;sys.argv = ['', 'Test.test_reload_custom_code_after_changes_in_class']